@@ -0,0 +1,111 @@
+"""
+Time and peak memory of the DICOM decoder on large multi-frame studies.
+
+For each file (or a synthetic CBCT-like multi-frame study when none is given)
+compares:
+  - decode_dicom(path): frame-by-frame from an mmap of the file
+  - decode_dicom(bytes): frame-by-frame from an in-memory upload
+  - naive: dcmread(...).pixel_array, the whole volume at once, then a projection
+Peak memory is the tracemalloc peak (numpy buffers included, mmap'd pages not).
+
+Usage:
+    python -m benchmarks.dicom_decode_benchmark [--frames 300] [--size 768] [--mode mip|middle] [file.dcm ...]
+"""
+import argparse
+import os
+import struct
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, SecondaryCaptureImageStorage, generate_uid
+
+from routes.dicom_decode import decode_dicom
+
+
+def synthetic_study(path: str, frames: int, size: int):
+    """12-bit multi-frame study written frame by frame, so generating it does not need the whole volume either"""
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = "CT"
+    ds.Rows = ds.Columns = size
+    ds.NumberOfFrames = frames
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.RescaleSlope = 1
+    ds.RescaleIntercept = -1024
+    ds.save_as(path, enforce_file_format=True)
+
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:size, :size]
+    with open(path, "ab") as f:
+        # (7FE0,0010) OW, explicit VR little endian
+        f.write(struct.pack("<HH2sHI", 0x7FE0, 0x0010, b"OW", 0, frames * size * size * 2))
+        for index in range(frames):
+            radius = size * (0.2 + 0.2 * np.sin(np.pi * index / frames))
+            disc = ((yy - size / 2) ** 2 + (xx - size / 2) ** 2 < radius ** 2) * 1500
+            frame = np.clip(disc + rng.normal(1024, 60, (size, size)), 0, 4095).astype("<u2")
+            f.write(frame.tobytes())
+
+
+def measure(label: str, func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = (time.perf_counter() - start) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {label:<24} {elapsed:>9.0f} ms {peak / 1024 / 1024:>9.1f} MB peak")
+
+
+def naive(path: str, mode: str):
+    volume = pydicom.dcmread(path).pixel_array
+    return volume.max(axis=0) if mode == "mip" and volume.ndim == 3 else volume[len(volume) // 2]
+
+
+def run(args):
+    paths = list(args.files)
+    tmp_path = None
+    if not paths:
+        tmp_path = os.path.join(tempfile.mkdtemp(), "synthetic_cbct.dcm")
+        print(f"Writing synthetic study: {args.frames} frames of {args.size}x{args.size}")
+        synthetic_study(tmp_path, args.frames, args.size)
+        paths = [tmp_path]
+
+    try:
+        for path in paths:
+            print(f"{os.path.basename(path)} ({os.path.getsize(path) / 1024 / 1024:.0f} MB)")
+            measure("decode_dicom(path)", lambda: decode_dicom(path, frame_mode=args.mode))
+            with open(path, "rb") as f:
+                contents = f.read()
+            measure("decode_dicom(bytes)", lambda: decode_dicom(contents, frame_mode=args.mode))
+            del contents
+            if not args.skip_naive:
+                measure("naive pixel_array", lambda: naive(path, args.mode))
+    finally:
+        if tmp_path:
+            os.remove(tmp_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--size", type=int, default=768)
+    parser.add_argument("--mode", choices=["mip", "middle"], default="mip")
+    parser.add_argument("--skip-naive", action="store_true", help="skip the whole-volume baseline")
+    run(parser.parse_args())
@@ -0,0 +1,132 @@
+"""
+Local stand-in for the Gemini API with injectable latency and errors.
+
+Answers generateContent, streamGenerateContent, embedContent and
+batchEmbedContents for any model with canned responses, after a delay drawn
+per model. Point the app (or a benchmark) at it with GEMINI_BASE_URL.
+
+Usage:
+    python -m benchmarks.fake_gemini_server --port 8090 \\
+        --delay gemini-1.5-flash=0.4 --delay gemini-2.0-flash=0.2 --jitter 0.5 \\
+        --slow-rate gemini-1.5-flash=0.1 --slow-delay 5 --error-rate gemini-2.0-flash=0.02
+    GEMINI_BASE_URL=http://127.0.0.1:8090 uvicorn main:app
+
+Delays can be changed while it runs:
+    curl -X POST localhost:8090/_control -d '{"gemini-1.5-flash": {"delay": 3}}'
+"""
+import argparse
+import asyncio
+import json
+import random
+from typing import Dict
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBEDDING_DIM = 768
+
+app = FastAPI(title="Fake Gemini API")
+
+# model (or "*") -> {"delay", "jitter", "slow_rate", "slow_delay", "error_rate"}
+behaviour: Dict[str, Dict[str, float]] = {"*": {}}
+calls: Dict[str, int] = {}
+
+
+def _setting(model: str, key: str, default: float = 0.0) -> float:
+    return behaviour.get(model, {}).get(key, behaviour["*"].get(key, default))
+
+
+async def _simulate(model: str):
+    calls[model] = calls.get(model, 0) + 1
+    delay = _setting(model, "delay")
+    delay *= 1 + random.uniform(-1, 1) * _setting(model, "jitter")
+    if random.random() < _setting(model, "slow_rate"):
+        delay = _setting(model, "slow_delay", 5.0)
+    await asyncio.sleep(max(delay, 0.0))
+    if random.random() < _setting(model, "error_rate"):
+        raise HTTPException(status_code=503, detail=f"Injected error from {model}")
+
+
+def _generate_response(model: str, body: dict) -> dict:
+    prompt_chars = len(json.dumps(body.get("contents", "")))
+    return {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": f"Fake answer from {model}."}]},
+            "finishReason": "STOP",
+            "index": 0,
+        }],
+        "usageMetadata": {
+            "promptTokenCount": prompt_chars // 4,
+            "candidatesTokenCount": 6,
+            "totalTokenCount": prompt_chars // 4 + 6,
+        },
+        "modelVersion": model,
+    }
+
+
+def _embedding(text: str) -> dict:
+    rng = random.Random(text)
+    return {"values": [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIM)]}
+
+
+@app.post("/{version}/models/{model_action}")
+async def model_action(version: str, model_action: str, request: Request):
+    model, _, action = model_action.partition(":")
+    body = await request.json()
+    await _simulate(model)
+
+    if action == "generateContent":
+        return _generate_response(model, body)
+    if action == "streamGenerateContent":
+        async def events():
+            for word in f"Fake streamed answer from {model}.".split():
+                chunk = _generate_response(model, body)
+                chunk["candidates"][0]["content"]["parts"][0]["text"] = word + " "
+                yield f"data: {json.dumps(chunk)}\r\n\r\n"
+                await asyncio.sleep(0.01)
+        return StreamingResponse(events(), media_type="text/event-stream")
+    if action == "embedContent":
+        return {"embedding": _embedding(json.dumps(body.get("content")))}
+    if action == "batchEmbedContents":
+        return {"embeddings": [_embedding(json.dumps(item.get("content"))) for item in body.get("requests", [])]}
+    return JSONResponse(status_code=404, content={"error": {"message": f"Unknown action {action}"}})
+
+
+@app.post("/_control")
+async def control(request: Request):
+    """Merge {"model": {"delay": ..., ...}} into the current behaviour"""
+    for model, settings in (await request.json()).items():
+        behaviour.setdefault(model, {}).update(settings)
+    return {"behaviour": behaviour}
+
+
+@app.get("/_stats")
+async def stats():
+    return {"behaviour": behaviour, "calls": calls}
+
+
+def _model_values(pairs) -> Dict[str, float]:
+    values = {}
+    for pair in pairs or []:
+        model, _, value = pair.rpartition("=")
+        values[model or "*"] = float(value)
+    return values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--delay", action="append", help="[model=]seconds, repeatable")
+    parser.add_argument("--jitter", type=float, default=0.0, help="relative +/- jitter on every delay")
+    parser.add_argument("--slow-rate", action="append", help="[model=]fraction of calls that take --slow-delay")
+    parser.add_argument("--slow-delay", type=float, default=5.0)
+    parser.add_argument("--error-rate", action="append", help="[model=]fraction of calls answered with 503")
+    args = parser.parse_args()
+
+    behaviour["*"].update({"jitter": args.jitter, "slow_delay": args.slow_delay})
+    for key, pairs in (("delay", args.delay), ("slow_rate", args.slow_rate), ("error_rate", args.error_rate)):
+        for model, value in _model_values(pairs).items():
+            behaviour.setdefault(model, {})[key] = value
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,67 @@
+"""
+Bytes sent and latency before/after the image pre-processing stage.
+
+For each image (or a synthetic 4000x3000 photo-like PNG when none is given)
+reports the original size, the pre-processed size and the pre-processing
+time. With --gemini, both versions are also sent to the vision model and the
+end-to-end latency of each call is reported.
+
+Usage:
+    python -m benchmarks.image_preprocess_benchmark [--radiograph] [--gemini] [image ...]
+"""
+import argparse
+import asyncio
+import io
+import time
+
+import numpy as np
+from google.genai import types
+from PIL import Image
+
+from routes import gemini_gateway
+from routes.image_preprocess import prepare_image, MIME_TYPES
+
+PROMPT = "Describe this dental image in one sentence."
+
+
+def synthetic_image() -> bytes:
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, 4000, dtype=np.float32)[None, :, None]
+    pixels = np.clip(gradient + rng.normal(0, 20, (3000, 4000, 3)), 0, 255).astype(np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="PNG")
+    return output.getvalue()
+
+
+async def timed_call(part) -> float:
+    start = time.perf_counter()
+    await gemini_gateway.generate_content(model="gemini-1.5-flash", contents=[PROMPT, part])
+    return (time.perf_counter() - start) * 1000
+
+
+async def run(args):
+    inputs = [(path, open(path, "rb").read()) for path in args.images] or [("synthetic.png", synthetic_image())]
+    print(f"{'image':>24} {'original':>10} {'sent':>10} {'ratio':>6} {'prep ms':>8} {'model ms (orig/prep)':>22}")
+    for name, contents in inputs:
+        start = time.perf_counter()
+        prepared = await prepare_image(contents, radiograph=args.radiograph)
+        prep_ms = (time.perf_counter() - start) * 1000
+
+        model_ms = ""
+        if args.gemini:
+            fmt = Image.open(io.BytesIO(contents)).format or "PNG"
+            original_part = types.Part.from_bytes(data=contents, mime_type=MIME_TYPES.get(fmt, "image/png"))
+            original_ms = await timed_call(original_part)
+            prepared_ms = await timed_call(prepared.to_part())
+            model_ms = f"{original_ms:.0f}/{prepared_ms + prep_ms:.0f}"
+
+        print(f"{name[-24:]:>24} {len(contents) / 1024:>9.0f}K {len(prepared.data) / 1024:>9.0f}K "
+              f"{len(contents) / len(prepared.data):>5.1f}x {prep_ms:>8.1f} {model_ms:>22}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--radiograph", action="store_true", help="grayscale conversion as for X-rays")
+    parser.add_argument("--gemini", action="store_true", help="also time the vision call for both versions")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,54 @@
+"""
+Query latency of the in-process NumPy vector index on a synthetic corpus.
+
+Builds a throwaway snapshot of random 768-dim vectors and times top-k cosine
+queries, so the numbers can be compared with a pgvector round trip
+(see vector_index_benchmark.py).
+
+Usage:
+    python -m benchmarks.local_vector_index_benchmark --rows 300000 --queries 200 --k 5
+"""
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from routes.local_vector_index import TypeIndex, EMBEDDING_DIM
+
+
+def run(args):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        index = TypeIndex("Bench", Path(directory))
+        start = time.perf_counter()
+        for offset in range(0, args.rows, 50000):
+            size = min(50000, args.rows - offset)
+            index.append(
+                np.arange(offset + 1, offset + size + 1, dtype=np.int64),
+                rng.standard_normal((size, EMBEDDING_DIM), dtype=np.float32),
+                [f"row {i}" for i in range(offset, offset + size)]
+            )
+        print(f"built {index.count} rows in {time.perf_counter() - start:.2f}s "
+              f"({index.capacity * EMBEDDING_DIM * 4 / 2**20:.0f} MiB mapped)")
+
+        queries = rng.standard_normal((args.queries, EMBEDDING_DIM), dtype=np.float32)
+        index.search(queries[0], args.k)  # warm the page cache
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query, args.k)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        print(f"k={args.k} queries={args.queries} mean={statistics.mean(timings):.2f}ms "
+              f"p50={timings[len(timings) // 2]:.2f}ms p95={timings[int(len(timings) * 0.95) - 1]:.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=300000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    run(parser.parse_args())
@@ -0,0 +1,67 @@
+"""
+Tail latency with and without hedged requests.
+
+Sends the same number of generate_content calls through a ModelRouter with
+hedging off and on and reports p50/p95/p99 plus how often the hedge fired and
+won. Meant to run against benchmarks/fake_gemini_server.py with a slow tail
+injected on the primary model.
+
+Usage:
+    python -m benchmarks.fake_gemini_server --delay 0.3 --jitter 0.3 \\
+        --slow-rate gemini-1.5-flash=0.1 --slow-delay 4 &
+    GEMINI_BASE_URL=http://127.0.0.1:8090 Gemini_api_key=fake \\
+        python -m benchmarks.model_router_benchmark --calls 300 --concurrency 8
+"""
+import argparse
+import asyncio
+import math
+import time
+
+from routes import model_router as router_module
+from routes.model_router import ModelRouter
+
+PROMPT = "Summarize: patient reports mild sensitivity on tooth 36."
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+async def measure(router: ModelRouter, model: str, calls: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await router.generate_content(model=model, contents=PROMPT)
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+
+    await asyncio.gather(*(one() for _ in range(calls)))
+    return latencies, errors
+
+
+async def run(args):
+    # Let the percentiles warm up quickly in a short run
+    router_module.MODEL_HEDGE_MIN_SAMPLES = args.warmup
+    print(f"{'hedging':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'hedged':>7} {'won':>5}")
+    for hedge in (False, True):
+        router = ModelRouter(hedge=hedge)
+        latencies, errors = await measure(router, args.model, args.calls, args.concurrency)
+        print(f"{'on' if hedge else 'off':>8} {percentile(latencies, 50) * 1000:>8.0f} "
+              f"{percentile(latencies, 95) * 1000:>8.0f} {percentile(latencies, 99) * 1000:>8.0f} "
+              f"{errors:>7} {router.counters['hedged']:>7} {router.counters['hedge_wins']:>5}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="gemini-1.5-flash")
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=20, help="samples before the percentile hedge delay is used")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,91 @@
+"""
+Recall and latency of the ANN vector indexes against exact search.
+
+Samples stored vectors of one type as queries, runs each query once with the
+index disabled (exact scan) and once per ef_search / probes value, and
+reports recall@k and latency percentiles.
+
+Usage:
+    python -m benchmarks.vector_index_benchmark --type Xray --queries 200 --k 5 --ef-search 20 40 80 160
+"""
+import argparse
+import os
+import statistics
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+from routes.vector_index import VECTOR_INDEX_METHOD
+
+load_dotenv()
+
+SIMILARITY_QUERY = """
+    SELECT id FROM evaluation WHERE type = %s
+    ORDER BY vector <=> %s::vector
+    LIMIT %s
+"""
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def timed_search(cur, type_value, vector, k):
+    start = time.perf_counter()
+    cur.execute(SIMILARITY_QUERY, (type_value, vector, k))
+    ids = [row[0] for row in cur.fetchall()]
+    return ids, (time.perf_counter() - start) * 1000
+
+
+def run(args):
+    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    cur.execute(
+        "SELECT vector::text FROM evaluation WHERE type = %s ORDER BY random() LIMIT %s",
+        (args.type, args.queries)
+    )
+    queries = [row[0] for row in cur.fetchall()]
+    if not queries:
+        raise SystemExit(f"No rows of type {args.type!r} to benchmark")
+
+    # Ground truth: exact scan with index scans disabled
+    cur.execute("SET enable_indexscan = off")
+    exact, exact_ms = [], []
+    for vector in queries:
+        ids, ms = timed_search(cur, args.type, vector, args.k)
+        exact.append(set(ids))
+        exact_ms.append(ms)
+    cur.execute("SET enable_indexscan = on")
+
+    print(f"type={args.type} queries={len(queries)} k={args.k} method={VECTOR_INDEX_METHOD}")
+    print(f"{'setting':>22} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8}")
+    print(f"{'exact':>22} {1.0:>9.3f} {percentile(exact_ms, 50):>8.2f} {percentile(exact_ms, 95):>8.2f}")
+
+    setting = "hnsw.ef_search" if VECTOR_INDEX_METHOD == "hnsw" else "ivfflat.probes"
+    values = args.ef_search if VECTOR_INDEX_METHOD == "hnsw" else args.probes
+    for value in values:
+        cur.execute(f"SET {setting} = {int(value)}")
+        recalls, ann_ms = [], []
+        for vector, truth in zip(queries, exact):
+            ids, ms = timed_search(cur, args.type, vector, args.k)
+            recalls.append(len(truth.intersection(ids)) / max(len(truth), 1))
+            ann_ms.append(ms)
+        print(f"{setting + '=' + str(value):>22} {statistics.mean(recalls):>9.3f} "
+              f"{percentile(ann_ms, 50):>8.2f} {percentile(ann_ms, 95):>8.2f}")
+
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--type", default="Xray")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[20, 40, 80, 160])
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 5, 10, 20])
+    run(parser.parse_args())
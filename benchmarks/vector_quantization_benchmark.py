@@ -0,0 +1,129 @@
+"""
+Footprint, latency and recall@k of compact two-stage search against exact search.
+
+Compares, for one evaluation.type:
+  * exact       - full scan over the float32 column (index scans disabled)
+  * full ANN    - the float32 HNSW/IVFFlat index, if present
+  * compact     - compact-index candidates reranked with float32, per candidate count
+
+Run `python -m routes.vector_quantization migrate --mode <mode>` first.
+
+Usage:
+    python -m benchmarks.vector_quantization_benchmark --mode halfvec --type Xray --candidates 20 40 80
+"""
+import argparse
+import os
+import statistics
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+from routes.vector_quantization import COMPACT_MODES, compact_index_name, compact_similarity_query
+from routes.vector_index import index_name, VECTOR_INDEX_METHOD, HNSW_EF_SEARCH
+
+load_dotenv()
+
+EXACT_QUERY = """
+    SELECT text FROM evaluation WHERE type = %s
+    ORDER BY vector <=> %s::vector LIMIT %s
+"""
+
+
+def to_psycopg(query: str) -> str:
+    # The app query is written for asyncpg ($n placeholders)
+    for n in (4, 3, 2, 1):
+        query = query.replace(f"${n}", f"%(p{n})s")
+    return query
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def relation_size(cur, name):
+    cur.execute("SELECT pg_relation_size(to_regclass(%s))", (name,))
+    return cur.fetchone()[0]
+
+
+def timed(cur, query, params):
+    start = time.perf_counter()
+    cur.execute(query, params)
+    rows = [row[0] for row in cur.fetchall()]
+    return rows, (time.perf_counter() - start) * 1000
+
+
+def report(label, truths, results, timings):
+    recall = statistics.mean(len(t.intersection(r)) / max(len(t), 1) for t, r in zip(truths, results))
+    print(f"{label:>24} {recall:>9.3f} {percentile(timings, 50):>8.2f} {percentile(timings, 95):>8.2f}")
+
+
+def run(args):
+    spec = COMPACT_MODES[args.mode]
+    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    print("Footprint")
+    cur.execute(
+        f"SELECT count(*), avg(pg_column_size(vector)), avg(pg_column_size({spec['column']})) "
+        f"FROM evaluation WHERE type = %s",
+        (args.type,)
+    )
+    rows, full_bytes, compact_bytes = cur.fetchone()
+    print(f"  rows={rows} avg float32 value={full_bytes or 0:.0f}B avg {args.mode} value={compact_bytes or 0:.0f}B")
+    print(f"  table (incl. TOAST) = {relation_size(cur, 'evaluation') / 2**20:.1f} MiB")
+    full_index = index_name(args.type, VECTOR_INDEX_METHOD)
+    print(f"  {full_index} = {(relation_size(cur, full_index) or 0) / 2**20:.1f} MiB")
+    compact_index = compact_index_name(args.type, args.mode)
+    print(f"  {compact_index} = {(relation_size(cur, compact_index) or 0) / 2**20:.1f} MiB")
+
+    cur.execute(
+        "SELECT vector::text FROM evaluation WHERE type = %s ORDER BY random() LIMIT %s",
+        (args.type, args.queries)
+    )
+    queries = [row[0] for row in cur.fetchall()]
+    if not queries:
+        raise SystemExit(f"No rows of type {args.type!r} to benchmark")
+
+    print(f"\n{'search':>24} {'recall@' + str(args.k):>9} {'p50 ms':>8} {'p95 ms':>8}")
+    cur.execute("SET enable_indexscan = off")
+    truths, timings = [], []
+    for vector in queries:
+        rows, ms = timed(cur, EXACT_QUERY, (args.type, vector, args.k))
+        truths.append(set(rows))
+        timings.append(ms)
+    cur.execute("SET enable_indexscan = on")
+    report("exact", truths, [list(t) for t in truths], timings)
+
+    cur.execute(f"SET hnsw.ef_search = {HNSW_EF_SEARCH}")
+    results, timings = [], []
+    for vector in queries:
+        rows, ms = timed(cur, EXACT_QUERY, (args.type, vector, args.k))
+        results.append(rows)
+        timings.append(ms)
+    report(f"full {VECTOR_INDEX_METHOD}", truths, results, timings)
+
+    query = to_psycopg(compact_similarity_query(args.mode))
+    for candidates in args.candidates:
+        cur.execute(f"SET hnsw.ef_search = {max(HNSW_EF_SEARCH, candidates)}")
+        results, timings = [], []
+        for vector in queries:
+            rows, ms = timed(cur, query, {"p1": args.type, "p2": vector, "p3": candidates, "p4": args.k})
+            results.append(rows)
+            timings.append(ms)
+        report(f"{args.mode} + rerank({candidates})", truths, results, timings)
+
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=sorted(COMPACT_MODES), default="halfvec")
+    parser.add_argument("--type", default="Xray")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--candidates", type=int, nargs="+", default=[20, 40, 80])
+    run(parser.parse_args())
@@ -1,16 +1,40 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from routes import items , Xray_checking , treatment_plan , Scan_dental , report_summary , exercise_fetch , Ai_scribe , soap_note , Email_sender  , Add_Data , auth  , Bolna , appoinment , integration , drug_info , ReportRag
+from routes import items , Xray_checking , treatment_plan , Scan_dental , report_summary , exercise_fetch , Ai_scribe , soap_note , Email_sender  , Add_Data , auth  , Bolna , appoinment , integration , drug_info , ReportRag , jobs
+from routes import db_pool, image_preprocess, report_ocr
+from routes.job_queue import job_queue
+from routes.local_vector_index import local_vector_index
+from routes.model_router import model_router
+from routes.soap_note_store import soap_note_store
+from routes.uploads import add_upload_limits
 from cors_config import add_cors
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Process-wide resources shared by all requests
+    await db_pool.create_pools()
+    await local_vector_index.start()
+    await soap_note_store.start()
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await soap_note_store.stop()
+    await local_vector_index.stop()
+    await db_pool.close_pools()
+    image_preprocess.shutdown_executor()
+    report_ocr.shutdown_executor()
+
 
 app = FastAPI(
     title="Basic FastAPI Example",
     description="A simple FastAPI application structure",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
 add_cors(app)
+add_upload_limits(app)
 
 # Include the routes
 app.include_router(items.router)
@@ -29,6 +53,7 @@ app.include_router(appoinment.router)
 app.include_router(integration.router)
 app.include_router(drug_info.router)
 app.include_router(ReportRag.router)
+app.include_router(jobs.router)
 
 
 @app.get("/")
@@ -36,6 +61,12 @@ async def root():
     return {"message": "Welcome to the FastAPI application"}
 
 
+@app.get("/model-router/stats")
+async def model_router_stats():
+    """Rolling p50/p95 latency and error rate per Gemini model, and hedging counters"""
+    return model_router.stats()
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -1,16 +1,37 @@
 import numpy as np
 import os
+import asyncio
+import time
 from dotenv import load_dotenv
 import psycopg2
-from google import genai
-from google.genai import types
+from routes import db_pool
+from routes.model_router import model_router
+from routes.embedding_cache import embedding_cache
+from routes.vector_index import search_settings
+from routes.local_vector_index import local_vector_index, RAG_RETRIEVAL_ENGINE
+from routes.vector_quantization import (
+    VECTOR_COMPACT_MODE, VECTOR_RERANK_CANDIDATES, compact_similarity_query, candidate_ef_search
+)
+from routes.context_assembler import RAG_CANDIDATES, AssembledContext, assemble_context, context_metrics
 load_dotenv()
 
+# Similarity query for the pooled path; asyncpg prepares it once per connection
+# and reuses the prepared statement from its statement cache afterwards
+SIMILARITY_QUERY = """
+    SELECT text, vector <=> $2 AS distance
+    FROM evaluation WHERE type = $1
+    ORDER BY vector <=> $2
+    LIMIT $3
+"""
+
 class RAGSystem:
     def __init__(self):
         try:
             self.conn = psycopg2.connect(os.getenv("DATABASE_URL"))
             self.cur = self.conn.cursor()
+            # ANN recall/speed tunables (ef_search, probes) for this session
+            for setting in search_settings():
+                self.cur.execute(setting)
         except psycopg2.DatabaseError as e:
             print(f"Database connection error: {e}")
             raise
@@ -18,42 +39,50 @@ class RAGSystem:
             print(f"Error initializing Gemini client or database: {e}")
             raise
 
-    def get_embedding(self, text):
+    async def get_embedding(self, text):
         try:
+            return await embedding_cache.get_embedding(text)
+        except Exception as e:
+            print(f"Error retrieving embedding: {e}")
+            raise
 
+    def _search_sync(self, type, query_embedding):
+        self.cur.execute("""
+            SELECT text, vector <=> %(embedding)s::vector AS distance
+            FROM evaluation WHERE type = %(type)s
+            ORDER BY vector <=> %(embedding)s::vector
+            LIMIT %(limit)s;
+        """, {"type": type, "embedding": query_embedding, "limit": RAG_CANDIDATES})
+        return self.cur.fetchall()
 
-            client = genai.Client(api_key=os.getenv("Gemini_api_key"))
+    async def search(self, type, query_embedding):
+        # psycopg2 is blocking, keep it off the event loop
+        return await asyncio.to_thread(self._search_sync, type, query_embedding)
 
-            result = client.models.embed_content(
-                model="text-embedding-004",
-                contents=text)
+    async def fetch_context(self, type, query_text, route) -> AssembledContext:
+        """
+        Nearest rows as (text, distance), filtered and fitted to the context token budget.
+        route is the context_metrics key; the caller records its prompt under the same one.
+        """
+        query_embedding = await self.get_embedding(query_text)
 
-            print(result.embeddings[0].values)
-        except Exception as e:
-            print(f"Error retrieving embedding: {e}")
-            raise
+        if RAG_RETRIEVAL_ENGINE == "numpy" and local_vector_index.ready(type):
+            # In-process index, kept in sync with Postgres by a background task; pgvector until it is loaded
+            results = await local_vector_index.search(type, query_embedding, k=RAG_CANDIDATES)
+        else:
+            results = await self.search(type, query_embedding)
+        print("*"*100)
+        print(results)
+        print("*"*100)
+        context = assemble_context(results or [])
+        context_metrics.record_context(route, context)
+        return context
 
-    def fetch_relevant_text(self, type , query_text):
+    async def fetch_relevant_text(self, type , query_text, route):
         try:
-            query_embedding = self.get_embedding(query_text)
-            embedding_vector = np.array(query_embedding, dtype=np.float32).tolist()
-
-            self.cur.execute("""
-                SELECT text 
-                FROM evaluation WHERE type = %s
-                ORDER BY vector <=> %s::vector
-                LIMIT 5;
-            """, (type,query_embedding,))
-
-            results = self.cur.fetchall()
-            if not results:
-                return None
-            print("*"*100)
-            print(results)
-            print("*"*100)
-            context_text = " ".join(result[0] for result in results)
-            print(context_text)
-            return context_text
+            context = await self.fetch_context(type, query_text, route)
+            print(context.text)
+            return context.text
         except psycopg2.Error as e:
             print(f"SQL execution error: {e}")
             raise
@@ -61,13 +90,10 @@ class RAGSystem:
             print(f"Unexpected error: {e}")
             raise
 
-    def get_answer_from_gpt(self, query_text, context_text):
+    async def get_answer_from_gpt(self, query_text, context_text, route):
         try:
-
-
-            client = genai.Client(api_key=os.getenv("Gemini_api_key"))
-
-            response = client.models.generate_content(
+            start = time.perf_counter()
+            response = await model_router.generate_content(
                 model="gemini-1.5-flash",
                 contents=f"""
 I will provide you with a current Medical Report analysis and a past Medical Report
@@ -79,6 +105,7 @@ current Medical Report analysis: {query_text} ,
 Past  Medical Report: {context_text}
 . if Past  Medical Report analysis is missing or irrelevant dont consider it . only return the analysis
 """)
+            context_metrics.record_prompt(route, response, time.perf_counter() - start)
             print(response.text)
             return response.text
         except Exception as e:
@@ -89,3 +116,37 @@ Past  Medical Report: {context_text}
         if self.conn:
             self.cur.close()
             self.conn.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Always release the connection, including on error paths
+        self.close()
+
+
+class AsyncRAGSystem(RAGSystem):
+    """
+    RAGSystem backed by the process-wide asyncpg pool. A connection is only
+    held for the duration of the similarity query.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool
+
+    async def search(self, type, query_embedding):
+        pool = self.pool or db_pool.get_pool()
+        embedding = np.array(query_embedding, dtype=np.float32)
+        async with pool.acquire() as conn:
+            if VECTOR_COMPACT_MODE == "off":
+                return await conn.fetch(SIMILARITY_QUERY, type, embedding, RAG_CANDIDATES)
+            # Candidates from the compact index, reranked with the exact float32 vectors
+            async with conn.transaction():
+                await conn.execute(f"SET LOCAL hnsw.ef_search = {candidate_ef_search()}")
+                return await conn.fetch(
+                    compact_similarity_query(), type, embedding, max(VECTOR_RERANK_CANDIDATES, RAG_CANDIDATES),
+                    RAG_CANDIDATES
+                )
+
+    def close(self):
+        pass
@@ -1,12 +1,17 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
-from google import generativeai as genai
 import os
+import time
 from dotenv import load_dotenv
-from routes.Rag_page import RAGSystem
-from google import genai
+from routes.Rag_page import AsyncRAGSystem
+from routes.model_router import model_router
+from routes.semantic_cache import report_answer_cache, context_fingerprint
+from routes.context_assembler import context_metrics
 
 load_dotenv()
 
+# context_metrics key of this route's retrieval and prompt
+REPORT_RAG_ROUTE = "/ReportRag/analyze"
+
 router = APIRouter(
     prefix="/ReportRag",
     tags=["ReportRag"],
@@ -16,7 +21,8 @@ router = APIRouter(
 @router.post("/analyze")
 async def analyze_xray(text: str):
     try:
-        rag_system = RAGSystem()
+        # Pooled RAG system; connections are only held while querying
+        rag_system = AsyncRAGSystem()
 
 
 
@@ -24,13 +30,19 @@ async def analyze_xray(text: str):
 
         # Structure the response
 
-        relevant_text = rag_system.fetch_relevant_text( "Report" , text)
+        relevant_text = await rag_system.fetch_relevant_text( "Report" , text, REPORT_RAG_ROUTE)
         print(relevant_text)
 
+        # Reuse the answer of a near-identical question asked against the same context
+        # (the question embedding comes from the embedding cache, no extra round trip)
+        query_embedding = await rag_system.get_embedding(text)
+        fingerprint = context_fingerprint(relevant_text)
+        cached_answer = report_answer_cache.lookup("Report", query_embedding, fingerprint)
+        if cached_answer is not None:
+            return {"Response": cached_answer, "cached": True}
 
-        client = genai.Client(api_key=os.getenv("Gemini_api_key"))
-
-        response = client.models.generate_content(
+        start = time.perf_counter()
+        response = await model_router.generate_content(
             model="gemini-2.0-flash",
             contents=[f"""You are an AI assistant that performs retrieval-augmented generation (RAG) to answer questions based on the provided knowledge base. Follow these steps:
 Check if the retrieved content directly answers the user's question.
@@ -39,11 +51,14 @@ If no relevant information is found, respond with: 'No idea.' .  Never Miss any
 Now, answer the following question based on the available RAG content:
 
 User Question - {text} , retrieved content - {relevant_text}"""])
+        context_metrics.record_prompt(REPORT_RAG_ROUTE, response, time.perf_counter() - start)
 
         print(response.text)
-        rag_system.close()
+        answer = response.text.replace("\n", "").replace("\r", "").replace("**", " ")
+        report_answer_cache.store("Report", query_embedding, fingerprint, answer)
         analysis_result = {
-            "Response": response.text.replace("\n", "").replace("\r", "").replace("**", " "),
+            "Response": answer,
+            "cached": False,
         }
 
         return analysis_result
@@ -51,6 +66,15 @@ User Question - {text} , retrieved content - {relevant_text}"""])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
+@router.get("/cache/stats")
+async def cache_stats():
+    return report_answer_cache.stats()
+
+@router.get("/context/stats")
+async def context_stats():
+    """Context tokens sent vs. retrieved, rows dropped, and prompt tokens reported by the model"""
+    return context_metrics.stats()
+
 @router.get("/health")
 async def health_check():
     return {"status": "healthy", "message": "X-ray analysis service is running"}
@@ -1,14 +1,23 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
 from fastapi.responses import JSONResponse
-from google import generativeai as genai
+from google.genai import types
 from PIL import Image
+import asyncio
 import io
 import os
 import time
+from functools import partial
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 from dotenv import load_dotenv
-from routes.Rag_page import RAGSystem
+from routes.Rag_page import AsyncRAGSystem
+from routes.model_router import model_router
+from routes.image_preprocess import prepare_image, PreparedImage
+from routes.dicom_decode import is_dicom, prepare_dicom, read_dicom_metadata
+from routes.analysis_cache import analysis_cache
+from routes.job_queue import job_queue
+from routes.streaming import STREAMING_HEADERS, CleanupStreamingResponse, ndjson_line
+from routes.uploads import upload_memory, upload_size, read_upload
 
 # Load environment variables
 load_dotenv()
@@ -19,16 +28,31 @@ router = APIRouter(
     responses={404: {"description": "Not found"}}
 )
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("Gemini_api_key"))
+# Keep a copy of every upload on disk; off by default, uploads are only held in memory
+SCAN_RETAIN_UPLOADS = os.getenv("SCAN_RETAIN_UPLOADS", "false").lower() == "true"
 
-# Directory to temporarily store uploaded scans
-UPLOAD_DIR = Path("uploads/scans")
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+# Directory for retained scans
+UPLOAD_DIR = Path(os.getenv("SCAN_UPLOAD_DIR", "uploads/scans"))
+if SCAN_RETAIN_UPLOADS:
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+
+# Convert scans to grayscale before analysis (set when scans are radiographs)
+SCAN_GRAYSCALE = os.getenv("SCAN_GRAYSCALE", "false").lower() == "true"
+
+# Files of one /upload-multiple batch analyzed at the same time
+SCAN_BATCH_CONCURRENCY = int(os.getenv("SCAN_BATCH_CONCURRENCY", 4))
 
 # Allowed file types for dental scans
 ALLOWED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".dcm"}
 
+# Bump when SCAN_ANALYSIS_PROMPT changes; it is part of the result-cache key
+SCAN_ANALYSIS_PROMPT_VERSION = "1"
+SCAN_ANALYSIS_MODEL = "gemini-1.5-flash"
+SCAN_CACHE_NAMESPACE = f"/scans/upload:{SCAN_ANALYSIS_PROMPT_VERSION}:{SCAN_ANALYSIS_MODEL}:{'gray' if SCAN_GRAYSCALE else 'color'}"
+
+# Single, batch and queued scans report their RAG context and prompt under this context_metrics key
+SCAN_RAG_ROUTE = "/scans/upload"
+
 # Advanced prompt for scan analysis
 SCAN_ANALYSIS_PROMPT = """
 You are an expert dental AI assistant specializing in X-ray and dental scan analysis. Analyze the provided dental scan image and provide:
@@ -46,13 +70,13 @@ Use technical dental terminology and provide a structured response.
 def validate_file_extension(filename: str) -> bool:
     return Path(filename).suffix.lower() in ALLOWED_EXTENSIONS
 
-async def analyze_scan(image: Image.Image) -> str:
+async def analyze_scan(image: PreparedImage) -> str:
     """Analyze the scan using Gemini API"""
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')  # Adjust model name as needed
-        response = model.generate_content(
-            [SCAN_ANALYSIS_PROMPT, image],
-            generation_config=genai.types.GenerationConfig(
+        response = await model_router.generate_content(
+            model=SCAN_ANALYSIS_MODEL,
+            contents=[SCAN_ANALYSIS_PROMPT, image.to_part()],
+            config=types.GenerateContentConfig(
                 temperature=0.1,  # Low temperature for precise responses
                 max_output_tokens=1000  # Allow detailed responses
             )
@@ -61,6 +85,42 @@ async def analyze_scan(image: Image.Image) -> str:
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Scan analysis failed: {str(e)}")
 
+async def prepare_scan_image(contents: bytes) -> PreparedImage:
+    """DICOM studies go through the frame-by-frame decoder, everything else through Pillow"""
+    if is_dicom(contents):
+        image, _ = await prepare_dicom(contents)
+        return image
+    return await prepare_image(contents, radiograph=SCAN_GRAYSCALE)
+
+async def scan_header_metadata(contents: bytes) -> Optional[dict]:
+    # De-identified DICOM header fields for the response; None for ordinary images
+    if not is_dicom(contents):
+        return None
+    return await asyncio.to_thread(read_dicom_metadata, contents)
+
+async def run_scan_pipeline(contents: bytes) -> str:
+    """Vision analysis of one scan, then comparison with similar past scan findings"""
+    # Pooled RAG system; connections are only held while querying
+    rag_system = AsyncRAGSystem()
+
+    # Downscaled, metadata-free copy for analysis
+    image = await prepare_scan_image(contents)
+
+    analysis_result = await analyze_scan(image)
+    relevant_text = await rag_system.fetch_relevant_text("Scan", analysis_result, SCAN_RAG_ROUTE)
+    print(relevant_text)
+    return await rag_system.get_answer_from_gpt(analysis_result, relevant_text, SCAN_RAG_ROUTE)
+
+async def analyze_scan_cached(contents: bytes) -> dict:
+    """Cached analysis for these image bytes, running the pipeline on a miss"""
+    cached = await analysis_cache.get(SCAN_CACHE_NAMESPACE, contents)
+    if cached is not None:
+        return {"analysis": cached["analysis"], "cached": True}
+
+    analysis = await run_scan_pipeline(contents)
+    await analysis_cache.set(SCAN_CACHE_NAMESPACE, contents, {"analysis": analysis})
+    return {"analysis": analysis, "cached": False}
+
 db_config = {
             "dbname": "mydatabase",
             "user": "myuser",
@@ -69,14 +129,22 @@ db_config = {
             "port": 5432
         }
 
+def retain_upload(filename: str, contents: bytes):
+    """Keep a copy of the upload on disk (SCAN_RETAIN_UPLOADS only)"""
+    with open(UPLOAD_DIR / filename, "wb") as f:
+        f.write(contents)
+
+def stored_filename(original_filename: str, index: Optional[int] = None) -> str:
+    # Generate unique filename with timestamp
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    return f"{timestamp}_{original_filename}" if index is None else f"{timestamp}_{index}_{original_filename}"
+
 @router.post("/upload")
 async def upload_and_analyze_scan(file: UploadFile = File(...)):
     """
-    Upload a single dental scan file, analyze it, and delete it afterward
+    Upload a single dental scan file and analyze it. The upload is decoded from
+    memory and only written to UPLOAD_DIR when SCAN_RETAIN_UPLOADS is on.
     """
-    rag_system = RAGSystem()
-
-    file_path = None
     try:
         # Validate file extension
         if not validate_file_extension(file.filename):
@@ -85,114 +153,180 @@ async def upload_and_analyze_scan(file: UploadFile = File(...)):
                 detail=f"Invalid file type. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
             )
 
-        # Validate file size (max 10MB)
-        contents = await file.read()
-        file_size = len(contents)
-        if file_size > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File size exceeds 10MB limit")
-
-        # Convert to PIL Image for analysis
-        image = Image.open(io.BytesIO(contents))
-
-        # Generate unique filename with timestamp
-        timestamp = time.strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{file.filename}"
-        file_path = UPLOAD_DIR / filename
-
-        # Save the file temporarily
-        with open(file_path, "wb") as f:
-            f.write(contents)
-
-        # Analyze the scan
-        analysis_result = await analyze_scan(image)
-        relevant_text = rag_system.fetch_relevant_text("Scan",analysis_result)
-        print(relevant_text)
-        analysis = rag_system.get_answer_from_gpt(analysis_result, relevant_text)
+        # Size is checked before reading and again while reading in chunks
+        async with upload_memory.reserve(upload_size(file)):
+            contents = await read_upload(file)
+            file_size = len(contents)
+
+            filename = stored_filename(file.filename)
+            if SCAN_RETAIN_UPLOADS:
+                await asyncio.to_thread(retain_upload, filename, contents)
+
+            # Analyze the scan, or reuse the result for an identical image
+            result = await analyze_scan_cached(contents)
+
         # Metadata and analysis result
         metadata = {
             "filename": filename,
             "original_filename": file.filename,
             "size_bytes": file_size,
             "upload_time": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "analysis": analysis
+            "retained": SCAN_RETAIN_UPLOADS,
+            "dicom": await scan_header_metadata(contents),
+            "analysis": result["analysis"],
+            "cached": result["cached"]
         }
 
-        # Delete the file after analysis
-        if file_path.exists():
-            os.remove(file_path)
-
         return JSONResponse(content={
-            "message": "Scan uploaded, analyzed, and deleted successfully",
+            "message": "Scan uploaded and analyzed successfully",
             "metadata": metadata
         })
 
+    except HTTPException:
+        raise
     except Exception as e:
-        # Clean up file if it exists and an error occurs
-        if file_path and file_path.exists():
-            os.remove(file_path)
         raise HTTPException(status_code=500, detail=f"Upload and analysis failed: {str(e)}")
 
-@router.post("/upload-multiple")
-async def upload_and_analyze_multiple_scans(files: List[UploadFile] = File(...)):
+job_queue.register("scan", analyze_scan_cached)
+
+@router.post("/upload/jobs", status_code=202)
+async def submit_scan_job(file: UploadFile = File(...)):
     """
-    Upload multiple dental scan files, analyze them, and delete them afterward
+    Queue a scan analysis and return its job id immediately.
+    Poll GET /jobs/{job_id} or subscribe to GET /jobs/{job_id}/events for the result.
     """
-    uploaded_files = []
-    files_to_cleanup = []
-
-    try:
-        for file in files:
-            if not validate_file_extension(file.filename):
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Invalid file type for {file.filename}. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
-                )
-
-            contents = await file.read()
-            file_size = len(contents)
-            if file_size > 10 * 1024 * 1024:
-                raise HTTPException(status_code=400, detail=f"File {file.filename} exceeds 10MB limit")
+    if not validate_file_extension(file.filename):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
+        )
 
-            # Convert to PIL Image
-            image = Image.open(io.BytesIO(contents))
+    async with upload_memory.reserve(upload_size(file)):
+        contents = await read_upload(file)
+        job_id = await job_queue.submit(
+            "scan", contents, {"original_filename": file.filename, "size_bytes": len(contents)}
+        )
+    return {"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}
 
-            timestamp = time.strftime("%Y%m%d_%H%M%S")
-            filename = f"{timestamp}_{file.filename}"
-            file_path = UPLOAD_DIR / filename
+async def analyze_batch_item(index: int, original_filename: str, contents: Optional[bytes],
+                             error: Optional[str], semaphore: asyncio.Semaphore) -> dict:
+    """Analyze one file of a batch; failures are reported in the item instead of raised"""
+    try:
+        if error is not None:
+            raise HTTPException(status_code=413, detail=error)
+        if not validate_file_extension(original_filename):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid file type for {original_filename}. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
+            )
 
-            # Save the file temporarily
-            with open(file_path, "wb") as f:
-                f.write(contents)
+        async with semaphore:
+            # Downscaled, metadata-free copy for analysis
+            image = await prepare_scan_image(contents)
 
-            # Track files for cleanup
-            files_to_cleanup.append(file_path)
+            filename = stored_filename(original_filename, index)
+            if SCAN_RETAIN_UPLOADS:
+                await asyncio.to_thread(retain_upload, filename, contents)
 
             # Analyze the scan
             analysis_result = await analyze_scan(image)
 
-            uploaded_files.append({
-                "filename": filename,
-                "original_filename": file.filename,
-                "size_bytes": file_size,
-                "upload_time": time.strftime("%Y-%m-%d %H:%M:%S"),
-                "analysis": analysis_result
-            })
+        return {
+            "index": index,
+            "status": "ok",
+            "filename": filename,
+            "original_filename": original_filename,
+            "size_bytes": len(contents),
+            "upload_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "retained": SCAN_RETAIN_UPLOADS,
+            "dicom": await scan_header_metadata(contents),
+            "analysis": analysis_result
+        }
 
-            # Delete the file after analysis
-            if file_path.exists():
-                os.remove(file_path)
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        return {"index": index, "status": "error", "original_filename": original_filename, "error": detail}
+
+async def stream_batch_results(tasks: List[asyncio.Task]):
+    """NDJSON line per file as soon as it finishes, then a summary line"""
+    failed = 0
+    for next_result in asyncio.as_completed(tasks):
+        result = await next_result
+        failed += result["status"] == "error"
+        yield ndjson_line(result)
+    yield ndjson_line({"done": True, "succeeded": len(tasks) - failed, "failed": failed})
+
+async def finish_batch(tasks: List[asyncio.Task], reserved_bytes: int):
+    """Stop the analyses nobody will read (client went away) and free the batch's upload memory"""
+    for task in tasks:
+        task.cancel()
+    await upload_memory.release(reserved_bytes)
 
-        return JSONResponse(content={
-            "message": f"Successfully uploaded, analyzed, and deleted {len(uploaded_files)} scan(s)",
-            "metadata": uploaded_files
-        })
+@router.post("/upload-multiple")
+async def upload_and_analyze_multiple_scans(files: List[UploadFile] = File(...), stream: bool = False):
+    """
+    Upload multiple dental scan files and analyze them concurrently.
+    Results are returned in input order; a file that fails is reported with status "error"
+    without failing the others. With stream=true each result is sent as an NDJSON line as
+    soon as it is ready (in completion order, with its input index).
+    """
+    # Oversize files become per-item errors; the rest is reserved in one step and read up front
+    sizes = []
+    for file in files:
+        try:
+            sizes.append(upload_size(file))
+        except HTTPException as e:
+            sizes.append(e.detail)
+    reserved_bytes = await upload_memory.acquire(sum(size for size in sizes if isinstance(size, int)))
 
-    except Exception as e:
-        # Clean up any remaining files if an error occurs
-        for file_path in files_to_cleanup:
-            if file_path.exists():
-                os.remove(file_path)
-        raise HTTPException(status_code=500, detail=f"Multiple upload and analysis failed: {str(e)}")
+    try:
+        uploads = []
+        for file, size in zip(files, sizes):
+            if isinstance(size, str):
+                uploads.append((file.filename, None, size))
+                continue
+            try:
+                uploads.append((file.filename, await read_upload(file), None))
+            except HTTPException as e:
+                uploads.append((file.filename, None, e.detail))
+
+        semaphore = asyncio.Semaphore(SCAN_BATCH_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(analyze_batch_item(index, filename, contents, error, semaphore))
+            for index, (filename, contents, error) in enumerate(uploads)
+        ]
+        del uploads
+    except BaseException:
+        await upload_memory.release(reserved_bytes)
+        raise
+
+    if stream:
+        # The reservation is handed to the response and released when it ends, even if the body never starts
+        return CleanupStreamingResponse(
+            stream_batch_results(tasks), cleanup=partial(finish_batch, tasks, reserved_bytes),
+            media_type="application/x-ndjson", headers=STREAMING_HEADERS
+        )
+
+    try:
+        # Cancelling the gather (client disconnect) cancels the pending analyses too
+        results = await asyncio.gather(*tasks)
+    finally:
+        await upload_memory.release(reserved_bytes)
+
+    succeeded = sum(1 for result in results if result["status"] == "ok")
+    return JSONResponse(content={
+        "message": f"Successfully uploaded and analyzed {succeeded} of {len(results)} scan(s)",
+        "metadata": results
+    })
+
+@router.get("/upload/stats")
+async def upload_memory_stats():
+    """Upload bytes currently held in memory, the peak since start, and waits for room"""
+    return upload_memory.stats()
+
+@router.get("/cache/stats")
+async def analysis_cache_stats():
+    return analysis_cache.stats()
 
 @router.get("/health")
 async def health_check():
@@ -1,10 +1,16 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
-from google import generativeai as genai
+from google.genai import types
 from PIL import Image
 import io
 import os
 from dotenv import load_dotenv
-from routes.Rag_page import RAGSystem
+from routes.Rag_page import AsyncRAGSystem
+from routes.model_router import model_router
+from routes.single_flight import single_flight, request_key
+from routes.image_preprocess import prepare_image
+from routes.analysis_cache import analysis_cache
+from routes.job_queue import job_queue
+from routes.uploads import upload_memory, upload_size, read_upload
 
 
 # Load environment variables
@@ -27,8 +33,13 @@ db_config = {
 
 
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("Gemini_api_key"))
+# Bump when DENTAL_ANALYSIS_PROMPT changes; it is part of the request-coalescing and result-cache keys
+DENTAL_ANALYSIS_PROMPT_VERSION = "1"
+XRAY_ANALYSIS_MODEL = "gemini-1.5-flash"
+XRAY_CACHE_NAMESPACE = f"/xray/analyze:{DENTAL_ANALYSIS_PROMPT_VERSION}:{XRAY_ANALYSIS_MODEL}"
+
+# context_metrics key of the comparison step (retrieved context and prompt); shared by every entry point
+XRAY_RAG_ROUTE = "/xray/analyze"
 
 # Advanced prompt for detailed dental analysis
 DENTAL_ANALYSIS_PROMPT = """
@@ -44,47 +55,90 @@ You are an expert dental AI assistant specializing in X-ray analysis. Analyze th
 Use technical dental terminology and provide a structured response.
 """
 
+async def run_xray_pipeline(contents: bytes) -> str:
+    """Vision analysis of one X-ray, then comparison with similar past X-ray findings"""
+    # Pooled RAG system; connections are only held while querying
+    rag_system = AsyncRAGSystem()
+
+    # Downscaled, grayscale, metadata-free copy for the vision call
+    image = await prepare_image(contents, radiograph=True)
+
+    # Generate analysis with advanced prompting
+    response = await model_router.generate_content(
+        model=XRAY_ANALYSIS_MODEL,
+        contents=[DENTAL_ANALYSIS_PROMPT, image.to_part()],
+        config=types.GenerateContentConfig(
+            temperature=0.1,  # Low temperature for more precise responses
+            max_output_tokens=1000  # Allow detailed responses
+        )
+    )
+
+    relevant_text = await rag_system.fetch_relevant_text( "Xray" , response.text, XRAY_RAG_ROUTE)
+    print(relevant_text)
+    return await rag_system.get_answer_from_gpt(response.text, relevant_text, XRAY_RAG_ROUTE)
+
+async def analyze_xray_cached(contents: bytes) -> dict:
+    """Cached analysis for these image bytes, running the pipeline on a miss"""
+    cached = await analysis_cache.get(XRAY_CACHE_NAMESPACE, contents)
+    if cached is not None:
+        return {"analysis": cached["analysis"], "cached": True}
+
+    analysis = await run_xray_pipeline(contents)
+    await analysis_cache.set(XRAY_CACHE_NAMESPACE, contents, {"analysis": analysis})
+    return {"analysis": analysis, "cached": False}
+
 @router.post("/analyze")
 async def analyze_xray(file: UploadFile = File(...)):
     try:
-        rag_system = RAGSystem()
-
         # Validate file type
         if not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="Please upload an image file")
 
-        # Read and convert image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-
-        # Configure Gemini model
-        model = genai.GenerativeModel('gemini-1.5-flash')  # Adjust model name as needed
+        # Read image in chunks, within the size limit and the shared upload memory budget
+        async with upload_memory.reserve(upload_size(file)):
+            contents = await read_upload(file)
 
-        # Generate analysis with advanced prompting
-        response = model.generate_content(
-            [DENTAL_ANALYSIS_PROMPT, image],
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.1,  # Low temperature for more precise responses
-                max_output_tokens=1000  # Allow detailed responses
+            # Identical uploads already in flight share one cache lookup / pipeline run
+            result = await single_flight.do(
+                request_key("/xray/analyze", DENTAL_ANALYSIS_PROMPT_VERSION, contents),
+                analyze_xray_cached,
+                contents
             )
-        )
 
         # Structure the response
-
-        relevant_text = rag_system.fetch_relevant_text( "Xray" , response.text)
-        print(relevant_text)
-        analysis = rag_system.get_answer_from_gpt(response.text, relevant_text)
-        rag_system.close()
         analysis_result = {
             "filename": file.filename,
-            "analysis": analysis,
+            "analysis": result["analysis"],
+            "cached": result["cached"],
         }
 
         return analysis_result
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
+job_queue.register("xray", analyze_xray_cached)
+
+@router.post("/analyze/jobs", status_code=202)
+async def submit_xray_job(file: UploadFile = File(...)):
+    """
+    Queue an X-ray analysis and return its job id immediately.
+    Poll GET /jobs/{job_id} or subscribe to GET /jobs/{job_id}/events for the result.
+    """
+    if not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="Please upload an image file")
+
+    async with upload_memory.reserve(upload_size(file)):
+        contents = await read_upload(file)
+        job_id = await job_queue.submit("xray", contents, {"filename": file.filename})
+    return {"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}
+
+@router.get("/cache/stats")
+async def analysis_cache_stats():
+    return analysis_cache.stats()
+
 @router.get("/health")
 async def health_check():
     return {"status": "healthy", "message": "X-ray analysis service is running"}
\ No newline at end of file
@@ -0,0 +1,277 @@
+"""
+Content-addressed cache for image analysis results.
+
+Results are keyed by a namespace (route, prompt version, model) and the
+SHA-256 of the uploaded bytes. Perceptual matching is off by default: with
+ANALYSIS_CACHE_PERCEPTUAL=true a 64-bit dHash of the image is stored too, so
+a re-encoded or resized copy of the same radiograph finds the earlier result
+when the hashes are within ANALYSIS_CACHE_PHASH_DISTANCE bits. Low-contrast
+radiographs of different patients can also fall within that distance, so
+only enable it where returning another image's analysis is acceptable.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from PIL import Image, UnidentifiedImageError
+
+from routes.image_preprocess import run_in_pool
+
+# Load environment variables
+load_dotenv()
+
+# "memory" or "disk"
+ANALYSIS_CACHE_BACKEND = os.getenv("ANALYSIS_CACHE_BACKEND", "memory").lower()
+ANALYSIS_CACHE_DIR = Path(os.getenv("ANALYSIS_CACHE_DIR", "data/analysis_cache"))
+
+# Seconds a cached analysis stays valid
+ANALYSIS_CACHE_TTL_SECONDS = float(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+
+# Size bounds: entries for the memory backend, bytes on disk for the disk backend
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 5000))
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# Match re-encoded copies by perceptual hash (off: exact content hashes only)
+ANALYSIS_CACHE_PERCEPTUAL = os.getenv("ANALYSIS_CACHE_PERCEPTUAL", "false").lower() == "true"
+ANALYSIS_CACHE_PHASH_DISTANCE = int(os.getenv("ANALYSIS_CACHE_PHASH_DISTANCE", 4))
+
+
+def perceptual_hash(contents: bytes) -> int:
+    """64-bit difference hash of the image"""
+    image = Image.open(io.BytesIO(contents))
+    image.draft("L", (64, 64))  # JPEGs decode at a fraction of full size
+    pixels = list(image.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: int = ANALYSIS_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: dict) -> List[str]:
+        """Store the entry; returns the keys evicted to make room"""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._entries.popitem(last=False)[0])
+        return evicted
+
+    def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    def entries(self) -> Iterator[Tuple[str, dict]]:
+        return iter(list(self._entries.items()))
+
+
+class DiskBackend:
+    """
+    One JSON file per entry; least recently used files are removed past max_bytes.
+    The directory is scanned once at startup; after that file sizes and recency
+    are tracked in memory, so a write does not list the directory. Each process
+    tracks the files it knows about, so workers sharing a directory can together
+    exceed max_bytes until they restart.
+    """
+
+    def __init__(self, directory: Path = ANALYSIS_CACHE_DIR, max_bytes: int = ANALYSIS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # path -> size in bytes, least recently used first
+        self._sizes: "OrderedDict[Path, int]" = OrderedDict()
+        files = []
+        for path in self.directory.glob("*.json"):
+            try:
+                files.append((path.stat(), path))
+            except FileNotFoundError:
+                continue
+        for stat, path in sorted(files, key=lambda item: item[0].st_mtime):
+            self._sizes[path] = stat.st_size
+        self._total = sum(self._sizes.values())
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json"
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)  # mtime orders the startup scan
+            with self._lock:
+                if path in self._sizes:
+                    self._sizes.move_to_end(path)
+            return entry
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, key: str, entry: dict) -> List[str]:
+        """Store the entry; returns the keys evicted to make room"""
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        data = json.dumps({**entry, "key": key}).encode("utf-8")
+        with self._lock:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+            self._total += len(data) - self._sizes.pop(path, 0)
+            self._sizes[path] = len(data)
+            return self._evict()
+
+    def delete(self, key: str):
+        path = self._path(key)
+        with self._lock:
+            path.unlink(missing_ok=True)
+            self._total -= self._sizes.pop(path, 0)
+
+    def _evict(self) -> List[str]:
+        """Remove least recently used files until the total fits; caller holds the lock"""
+        evicted = []
+        while self._total > self.max_bytes and self._sizes:
+            path, size = self._sizes.popitem(last=False)
+            self._total -= size
+            try:
+                evicted.append(json.loads(path.read_text(encoding="utf-8"))["key"])
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+            path.unlink(missing_ok=True)
+        return evicted
+
+    def entries(self) -> Iterator[Tuple[str, dict]]:
+        for path in self.directory.glob("*.json"):
+            try:
+                entry = json.loads(path.read_text(encoding="utf-8"))
+                yield entry["key"], entry
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+
+
+class AnalysisCache:
+    def __init__(self, backend, ttl: float = ANALYSIS_CACHE_TTL_SECONDS,
+                 perceptual: bool = ANALYSIS_CACHE_PERCEPTUAL, max_distance: int = ANALYSIS_CACHE_PHASH_DISTANCE):
+        self.backend = backend
+        self.ttl = ttl
+        self.perceptual = perceptual
+        self.max_distance = max_distance
+        self._blocking = isinstance(backend, DiskBackend)
+        # namespace -> {key: perceptual hash}, rebuilt from the backend on first use
+        self._phash_index: Optional[Dict[str, Dict[str, int]]] = None
+        self.counters = {"exact_hits": 0, "perceptual_hits": 0, "misses": 0, "expired": 0, "errors": 0}
+
+    async def _backend(self, method, *args):
+        if self._blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def _index(self) -> Dict[str, Dict[str, int]]:
+        if self._phash_index is None:
+            entries = await self._backend(lambda: list(self.backend.entries()))
+            index: Dict[str, Dict[str, int]] = {}
+            for key, entry in entries:
+                if entry.get("phash") is not None:
+                    index.setdefault(entry["namespace"], {})[key] = entry["phash"]
+            self._phash_index = index
+        return self._phash_index
+
+    async def _perceptual_hash(self, contents: bytes) -> Optional[int]:
+        if not self.perceptual:
+            return None
+        try:
+            return await run_in_pool(perceptual_hash, contents)
+        except (UnidentifiedImageError, OSError):
+            # Not something Pillow can open (e.g. DICOM): exact matches only
+            return None
+
+    async def _get_fresh(self, key: str) -> Optional[dict]:
+        entry = await self._backend(self.backend.get, key)
+        if entry is not None and time.time() - entry["created_at"] > self.ttl:
+            await self._backend(self.backend.delete, key)
+            self.counters["expired"] += 1
+            return None
+        return entry
+
+    async def get(self, namespace: str, contents: bytes) -> Optional[dict]:
+        """Cached value for these image bytes (or a perceptually identical image)"""
+        try:
+            entry = await self._get_fresh(f"{namespace}:{hashlib.sha256(contents).hexdigest()}")
+            if entry is not None:
+                self.counters["exact_hits"] += 1
+                return entry["value"]
+
+            phash = await self._perceptual_hash(contents)
+            if phash is not None:
+                candidates = (await self._index()).get(namespace, {})
+                # One pass to find the near matches; only those are sorted
+                near = []
+                for key, other in candidates.items():
+                    distance = bin(other ^ phash).count("1")
+                    if distance <= self.max_distance:
+                        near.append((distance, key))
+                for _, key in sorted(near):
+                    entry = await self._get_fresh(key)
+                    if entry is not None:
+                        self.counters["perceptual_hits"] += 1
+                        return entry["value"]
+                    candidates.pop(key, None)
+        except Exception:
+            # A broken cache must not fail the analysis
+            self.counters["errors"] += 1
+            logging.exception("Analysis cache lookup failed")
+        self.counters["misses"] += 1
+        return None
+
+    async def set(self, namespace: str, contents: bytes, value: dict):
+        key = f"{namespace}:{hashlib.sha256(contents).hexdigest()}"
+        try:
+            phash = await self._perceptual_hash(contents)
+            entry = {"namespace": namespace, "phash": phash, "created_at": time.time(), "value": value}
+            evicted = await self._backend(self.backend.put, key, entry)
+            if self.perceptual:
+                index = await self._index()
+                if phash is not None:
+                    index.setdefault(namespace, {})[key] = phash
+                # Evicted entries leave the index too, so it stays as small as the backend
+                for evicted_key in evicted:
+                    index.get(evicted_key.rsplit(":", 1)[0], {}).pop(evicted_key, None)
+        except Exception:
+            self.counters["errors"] += 1
+            logging.exception("Analysis cache write failed")
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__,
+            "perceptual": self.perceptual,
+            "ttl_seconds": self.ttl,
+            **self.counters,
+        }
+
+
+def create_analysis_cache(perceptual: bool = ANALYSIS_CACHE_PERCEPTUAL) -> AnalysisCache:
+    backend = DiskBackend() if ANALYSIS_CACHE_BACKEND == "disk" else MemoryBackend()
+    return AnalysisCache(backend, perceptual=perceptual)
+
+
+# Shared by /xray/analyze and /scans/upload
+analysis_cache = create_analysis_cache()
+
+# Per-page report summaries, keyed by the page's source content or extracted text; exact matches only
+page_summary_cache = create_analysis_cache(perceptual=False)
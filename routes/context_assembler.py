@@ -0,0 +1,181 @@
+"""
+Token-budgeted context for RAG prompts.
+
+Retrieved chunks arrive nearest first as (text, cosine distance). Chunks past
+RAG_MAX_DISTANCE are dropped as irrelevant, near-duplicates of an already
+chosen chunk (word-shingle Jaccard similarity >= RAG_DUPLICATE_SIMILARITY) are
+dropped, and the rest are added until RAG_CONTEXT_TOKEN_BUDGET is used; the
+chunk that crosses the budget is cut at a sentence boundary.
+
+Token counts are estimated locally (about RAG_CHARS_PER_TOKEN characters per
+token, which is close for English text with Gemini's tokenizer). The prompt
+token counts the model actually billed come from response.usage_metadata and
+are recorded next to the estimates in context_metrics.
+"""
+import math
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Most tokens of retrieved context put into one prompt
+RAG_CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", 1500))
+
+# Chunks farther than this cosine distance from the query are not used
+RAG_MAX_DISTANCE = float(os.getenv("RAG_MAX_DISTANCE", 0.6))
+
+# Chunks at least this similar to an already chosen one are dropped
+RAG_DUPLICATE_SIMILARITY = float(os.getenv("RAG_DUPLICATE_SIMILARITY", 0.8))
+
+# Rows retrieved before filtering; more than are kept so duplicates can be replaced
+RAG_CANDIDATES = int(os.getenv("RAG_CANDIDATES", 8))
+
+# Rows the routes joined into the prompt before assembly; the baseline for tokens saved
+RAG_BASELINE_CHUNKS = 5
+
+RAG_CHARS_PER_TOKEN = float(os.getenv("RAG_CHARS_PER_TOKEN", 4.0))
+
+# A partial chunk shorter than this is not worth adding
+MIN_PARTIAL_CHUNK_TOKENS = 32
+
+_WORD = re.compile(r"\w+")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    if not text:
+        return 0
+    return math.ceil(len(text) / RAG_CHARS_PER_TOKEN)
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = _WORD.findall(text.lower())
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _similarity(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Longest prefix of whole sentences within max_tokens (hard cut if the first sentence is too long)"""
+    max_chars = int(max_tokens * RAG_CHARS_PER_TOKEN)
+    kept = ""
+    for sentence in _SENTENCE_END.split(text):
+        candidate = f"{kept} {sentence}" if kept else sentence
+        if len(candidate) > max_chars:
+            break
+        kept = candidate
+    return kept or text[:max_chars]
+
+
+@dataclass
+class AssembledContext:
+    text: Optional[str]
+    tokens: int
+    chunks: int
+    candidate_tokens: int  # estimate for the nearest RAG_BASELINE_CHUNKS rows joined, as before assembly
+    dropped: Dict[str, int] = field(default_factory=lambda: {"distance": 0, "duplicate": 0, "budget": 0})
+
+
+def assemble_context(results: Iterable[Sequence], token_budget: int = RAG_CONTEXT_TOKEN_BUDGET,
+                     max_distance: float = RAG_MAX_DISTANCE,
+                     duplicate_similarity: float = RAG_DUPLICATE_SIMILARITY) -> AssembledContext:
+    """Build the context text from (text, distance) rows ordered nearest first"""
+    results = [(row[0], float(row[1]) if len(row) > 1 and row[1] is not None else 0.0) for row in results]
+    assembled = AssembledContext(
+        text=None, tokens=0, chunks=0,
+        candidate_tokens=estimate_tokens(" ".join(text for text, _ in results[:RAG_BASELINE_CHUNKS] if text))
+    )
+
+    chosen: List[Tuple[str, set]] = []
+    remaining = token_budget
+    for text, distance in results:
+        if not text:
+            continue
+        if distance > max_distance:
+            assembled.dropped["distance"] += 1
+            continue
+        shingles = _shingles(text)
+        if any(_similarity(shingles, other) >= duplicate_similarity for _, other in chosen):
+            assembled.dropped["duplicate"] += 1
+            continue
+        tokens = estimate_tokens(text)
+        if tokens > remaining:
+            if remaining >= MIN_PARTIAL_CHUNK_TOKENS:
+                text = _truncate(text, remaining)
+                tokens = estimate_tokens(text)
+            else:
+                assembled.dropped["budget"] += 1
+                continue
+        chosen.append((text, shingles))
+        remaining -= tokens
+
+    if chosen:
+        assembled.text = " ".join(text for text, _ in chosen)
+        assembled.tokens = estimate_tokens(assembled.text)
+        assembled.chunks = len(chosen)
+    return assembled
+
+
+class ContextMetrics:
+    """Per-route totals of context assembly and of the prompt tokens the model reported"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes: Dict[str, Dict[str, float]] = {}
+
+    def _route(self, route: str) -> Dict[str, float]:
+        return self._routes.setdefault(route, {
+            "assemblies": 0, "context_tokens": 0, "candidate_tokens": 0,
+            "dropped_distance": 0, "dropped_duplicate": 0, "dropped_budget": 0,
+            "calls": 0, "prompt_tokens": 0, "calls_without_usage": 0, "latency_seconds": 0.0,
+        })
+
+    def record_context(self, route: str, context: AssembledContext):
+        with self._lock:
+            totals = self._route(route)
+            totals["assemblies"] += 1
+            totals["context_tokens"] += context.tokens
+            totals["candidate_tokens"] += context.candidate_tokens
+            for reason, count in context.dropped.items():
+                totals[f"dropped_{reason}"] += count
+
+    def record_prompt(self, route: str, response, latency_seconds: float):
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", None)
+        with self._lock:
+            totals = self._route(route)
+            totals["calls"] += 1
+            totals["latency_seconds"] += latency_seconds
+            if prompt_tokens is None:
+                totals["calls_without_usage"] += 1
+            else:
+                totals["prompt_tokens"] += prompt_tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            report = {}
+            for route, totals in self._routes.items():
+                assemblies, calls = totals["assemblies"] or 1, totals["calls"] or 1
+                report[route] = {
+                    **totals,
+                    "avg_context_tokens": totals["context_tokens"] / assemblies,
+                    # What joining the top RAG_BASELINE_CHUNKS rows used to cost, minus what is sent now
+                    "avg_context_tokens_saved": (totals["candidate_tokens"] - totals["context_tokens"]) / assemblies,
+                    "avg_prompt_tokens": totals["prompt_tokens"] / max(calls - totals["calls_without_usage"], 1),
+                    "avg_latency_seconds": totals["latency_seconds"] / calls,
+                }
+            return {"token_budget": RAG_CONTEXT_TOKEN_BUDGET, "max_distance": RAG_MAX_DISTANCE, "routes": report}
+
+
+# Shared by the RAG routes
+context_metrics = ContextMetrics()
@@ -0,0 +1,72 @@
+import logging
+import os
+from typing import Dict, Optional
+
+import asyncpg
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from pgvector.asyncpg import register_vector
+
+from routes.vector_index import search_settings
+
+# Load environment variables
+load_dotenv()
+
+# Pool sizes per process
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+
+# Named pools created at app startup
+POOL_URLS = {
+    "evaluation": os.getenv("DATABASE_URL"),
+    # Application tables such as soap_notes
+    "app": os.getenv("DB_URL"),
+}
+
+_pools: Dict[str, asyncpg.Pool] = {}
+
+
+async def _init_evaluation_connection(conn):
+    await register_vector(conn)
+    for setting in search_settings():
+        await conn.execute(setting)
+    # Prepared statements must not fall back to a generic plan: the planner
+    # can only match the per-type partial indexes when it sees the literal type
+    await conn.execute("SET plan_cache_mode = force_custom_plan")
+
+
+_CONNECTION_INIT = {
+    "evaluation": _init_evaluation_connection,
+}
+
+
+async def create_pools():
+    """Create every configured pool; called once from the app lifespan"""
+    for name, url in POOL_URLS.items():
+        if not url or name in _pools:
+            continue
+        try:
+            _pools[name] = await asyncpg.create_pool(
+                url,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                init=_CONNECTION_INIT.get(name)
+            )
+        except Exception as e:
+            logging.exception(f"Error creating the {name} database pool: {str(e)}")
+
+
+async def close_pools():
+    for name in list(_pools):
+        await _pools.pop(name).close()
+
+
+def get_pool(name: str = "evaluation") -> asyncpg.Pool:
+    pool = _pools.get(name)
+    if pool is None:
+        raise HTTPException(status_code=503, detail=f"The {name} database pool is not available")
+    return pool
+
+
+def get_pool_or_none(name: str = "evaluation") -> Optional[asyncpg.Pool]:
+    return _pools.get(name)
@@ -0,0 +1,196 @@
+"""
+DICOM decoding for scan uploads.
+
+Pixel data is decoded one frame at a time with pydicom.pixels.iter_pixels,
+from an mmap of the file when the study is on disk or from the upload buffer
+otherwise, so a multi-frame CBCT export never has all of its frames in memory.
+Each frame is stride-downsampled towards the analysis resolution before any
+float conversion. A multi-frame study is reduced to one image: a
+maximum-intensity projection accumulated frame by frame, or just the middle
+frame (DICOM_FRAME_MODE). Window/level comes from the header when present,
+otherwise from the 1st-99th percentile of the image.
+
+Only Part 10 files (128-byte preamble + "DICM") are recognised as DICOM.
+Compressed transfer syntaxes need a pixel data plugin (pylibjpeg with its
+openjpeg and libjpeg plugins covers JPEG 2000, JPEG-LS and JPEG lossless);
+a file whose transfer syntax cannot be decoded here is rejected with 415
+before any pixel data is read.
+"""
+import asyncio
+import io
+import mmap
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import pydicom
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from PIL import Image
+from pydicom.multival import MultiValue
+from pydicom.pixels import get_decoder, iter_pixels
+
+from routes.image_preprocess import (
+    IMAGE_MAX_DIMENSION, IMAGE_OUTPUT_FORMAT, IMAGE_QUALITY, MIME_TYPES, PreparedImage, run_in_pool
+)
+
+# Load environment variables
+load_dotenv()
+
+# "mip" (maximum-intensity projection over all frames) or "middle" (middle frame only)
+DICOM_FRAME_MODE = os.getenv("DICOM_FRAME_MODE", "mip").lower()
+
+# Header fields returned with the analysis; nothing that identifies the patient
+METADATA_KEYWORDS = (
+    "Modality", "Manufacturer", "ManufacturerModelName", "BodyPartExamined",
+    "SeriesDescription", "ImageType", "Rows", "Columns", "NumberOfFrames",
+    "SamplesPerPixel", "PhotometricInterpretation", "BitsStored",
+    "PixelSpacing", "SliceThickness", "KVP", "XRayTubeCurrent", "ExposureTime",
+    "RescaleSlope", "RescaleIntercept", "WindowCenter", "WindowWidth",
+)
+
+
+def is_dicom(contents: bytes) -> bool:
+    return len(contents) >= 132 and contents[128:132] == b"DICM"
+
+
+def _json_value(value):
+    if isinstance(value, (MultiValue, list, tuple)):
+        return [_json_value(item) for item in value]
+    # IS and DS values subclass int and float
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    return str(value)
+
+
+def dicom_metadata(ds) -> dict:
+    metadata = {keyword: _json_value(ds.get(keyword)) for keyword in METADATA_KEYWORDS if ds.get(keyword) is not None}
+    file_meta = getattr(ds, "file_meta", None)
+    if file_meta is not None and "TransferSyntaxUID" in file_meta:
+        metadata["TransferSyntaxUID"] = str(file_meta.TransferSyntaxUID)
+    return metadata
+
+
+def read_dicom_metadata(contents: bytes) -> dict:
+    """Header fields only; pixel data is not read"""
+    return dicom_metadata(pydicom.dcmread(io.BytesIO(contents), stop_before_pixels=True, force=True))
+
+
+def missing_decoder(contents: bytes) -> Optional[str]:
+    """Why the pixel data of this file cannot be decoded here, or None if it can"""
+    ds = pydicom.dcmread(io.BytesIO(contents), stop_before_pixels=True, force=True)
+    file_meta = getattr(ds, "file_meta", None)
+    if file_meta is None or "TransferSyntaxUID" not in file_meta:
+        # pydicom falls back to implicit VR little endian, which is uncompressed
+        return None
+    transfer_syntax = file_meta.TransferSyntaxUID
+    try:
+        decoder = get_decoder(transfer_syntax)
+    except NotImplementedError:
+        return f"Transfer syntax {transfer_syntax.name} is not supported"
+    if not decoder.is_available:
+        return (
+            f"Transfer syntax {transfer_syntax.name} needs a pixel data plugin that is not installed "
+            f"({', '.join(decoder.missing_dependencies)})"
+        )
+    return None
+
+
+def _first(value) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, (MultiValue, list, tuple)):
+        value = value[0] if len(value) else None
+    return float(value) if value is not None else None
+
+
+def _window(pixels: np.ndarray, ds) -> np.ndarray:
+    """Rescale stored values and map the window to 0-255"""
+    slope = _first(ds.get("RescaleSlope")) or 1.0
+    intercept = _first(ds.get("RescaleIntercept")) or 0.0
+    values = pixels * slope + intercept
+
+    center, width = _first(ds.get("WindowCenter")), _first(ds.get("WindowWidth"))
+    if center is not None and width is not None and width > 1:
+        low, high = center - width / 2, center + width / 2
+    else:
+        low, high = (float(v) for v in np.percentile(values, (1, 99)))
+    if high <= low:
+        high = low + 1
+
+    scaled = (np.clip(values, low, high) - low) * (255.0 / (high - low))
+    if ds.get("PhotometricInterpretation") == "MONOCHROME1":
+        scaled = 255.0 - scaled
+    return scaled.astype(np.uint8)
+
+
+@contextmanager
+def _open_source(source: Union[bytes, str, Path]):
+    if isinstance(source, (bytes, bytearray)):
+        yield io.BytesIO(source)
+        return
+    # Pages of a file on disk are only loaded as pydicom reads them
+    with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        yield mapped
+
+
+def decode_dicom(source: Union[bytes, str, Path], max_dimension: int = IMAGE_MAX_DIMENSION,
+                 frame_mode: str = DICOM_FRAME_MODE, output_format: str = IMAGE_OUTPUT_FORMAT,
+                 quality: int = IMAGE_QUALITY) -> Tuple[PreparedImage, dict]:
+    """Decode a DICOM file (bytes or path) into a PreparedImage plus de-identified header metadata"""
+    with _open_source(source) as fp:
+        ds = pydicom.dcmread(fp, stop_before_pixels=True, force=True)
+        if "Rows" not in ds or "Columns" not in ds:
+            raise ValueError("DICOM file has no image data")
+
+        frames = int(ds.get("NumberOfFrames") or 1)
+        color = int(ds.get("SamplesPerPixel") or 1) > 1
+        # Integer stride down to about twice the target size; LANCZOS does the rest
+        step = max(1, max(int(ds.Rows), int(ds.Columns)) // (2 * max_dimension))
+        project = frames > 1 and frame_mode == "mip" and not color
+        # The brightest pixel has the lowest stored value in MONOCHROME1
+        reduce = np.fmin if ds.get("PhotometricInterpretation") == "MONOCHROME1" else np.fmax
+
+        fp.seek(0)
+        image = None
+        for frame in iter_pixels(fp, indices=None if project else [frames // 2]):
+            frame = frame[::step, ::step]
+            if image is None:
+                image = frame.astype(np.float32)
+            else:
+                reduce(image, frame, out=image)
+        if image is None:
+            raise ValueError("DICOM file has no image data")
+
+    if color:
+        bits = int(ds.get("BitsStored") or 8)
+        pixels = np.clip(image * (255.0 / (2 ** bits - 1)), 0, 255).astype(np.uint8)
+        picture = Image.fromarray(pixels, mode="RGB")
+    else:
+        picture = Image.fromarray(_window(image, ds), mode="L")
+    picture.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    picture.save(output, format=output_format, quality=quality, optimize=True)
+    metadata = dicom_metadata(ds)
+    metadata["FramesUsed"] = f"maximum-intensity projection of {frames}" if project else f"frame {frames // 2 + 1} of {frames}"
+    prepared = PreparedImage(
+        data=output.getvalue(),
+        mime_type=MIME_TYPES.get(output_format, f"image/{output_format.lower()}"),
+        width=picture.width,
+        height=picture.height,
+        original_bytes=len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+    )
+    return prepared, metadata
+
+
+async def prepare_dicom(contents: bytes, max_dimension: Optional[int] = None) -> Tuple[PreparedImage, dict]:
+    """Decode in the image worker pool so pydicom and numpy never block the event loop"""
+    reason = await asyncio.to_thread(missing_decoder, contents)
+    if reason is not None:
+        raise HTTPException(status_code=415, detail=f"Unsupported DICOM compression: {reason}")
+    return await run_in_pool(decode_dicom, contents, max_dimension or IMAGE_MAX_DIMENSION)
@@ -0,0 +1,115 @@
+import asyncio
+import os
+from typing import Any, AsyncIterator, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from google import genai
+from google.genai import types
+
+# Load environment variables
+load_dotenv()
+
+# Maximum number of Gemini requests allowed in flight at once (per process)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 8))
+
+# Default per-call timeout in seconds
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", 60))
+
+# Point the client at another endpoint, e.g. benchmarks/fake_gemini_server.py
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+
+_client: Optional[genai.Client] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def get_client() -> genai.Client:
+    """Return the single Gemini client shared by the whole process"""
+    global _client
+    if _client is None:
+        http_options = types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+        _client = genai.Client(api_key=os.getenv("Gemini_api_key"), http_options=http_options)
+    return _client
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+    return _semaphore
+
+
+async def _call(awaitable, model: str, timeout: Optional[float]):
+    timeout = timeout or GEMINI_TIMEOUT_SECONDS
+    async with _get_semaphore():
+        try:
+            return await asyncio.wait_for(awaitable, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=504,
+                detail=f"Gemini request to {model} timed out after {timeout:.0f}s"
+            )
+
+
+async def generate_content(
+    model: str,
+    contents: Any,
+    config: Optional[types.GenerateContentConfig] = None,
+    timeout: Optional[float] = None
+) -> types.GenerateContentResponse:
+    """
+    Run a non-blocking generate_content call through the shared client.
+    At most GEMINI_MAX_CONCURRENCY calls run at once; the rest wait their turn.
+    """
+    return await _call(
+        get_client().aio.models.generate_content(model=model, contents=contents, config=config),
+        model,
+        timeout
+    )
+
+
+async def generate_content_stream(
+    model: str,
+    contents: Any,
+    config: Optional[types.GenerateContentConfig] = None,
+    timeout: Optional[float] = None
+) -> AsyncIterator[str]:
+    """
+    Yield the text of each chunk as Gemini streams it. The timeout applies to
+    the wait for every chunk, and the concurrency slot is held until the
+    stream is finished or closed.
+    """
+    timeout = timeout or GEMINI_TIMEOUT_SECONDS
+    async with _get_semaphore():
+        try:
+            stream = await asyncio.wait_for(
+                get_client().aio.models.generate_content_stream(model=model, contents=contents, config=config),
+                timeout=timeout
+            )
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    yield chunk.text
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=504,
+                detail=f"Gemini stream from {model} stalled for more than {timeout:.0f}s"
+            )
+
+
+async def embed_content(
+    model: str,
+    contents: Any,
+    config: Optional[types.EmbedContentConfig] = None,
+    timeout: Optional[float] = None
+) -> types.EmbedContentResponse:
+    """Run a non-blocking embed_content call through the shared client"""
+    return await _call(
+        get_client().aio.models.embed_content(model=model, contents=contents, config=config),
+        model,
+        timeout
+    )
@@ -0,0 +1,110 @@
+import asyncio
+import io
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from google.genai import types
+from PIL import Image, ImageOps
+
+# Load environment variables
+load_dotenv()
+
+# Longest side, in pixels, of images sent to the vision model
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1536))
+
+# Re-encoding format and quality (JPEG or WEBP; PNG ignores quality)
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+
+# "thread" or "process"; Pillow releases the GIL for most decode/resize work
+IMAGE_PREPROCESS_EXECUTOR = os.getenv("IMAGE_PREPROCESS_EXECUTOR", "thread").lower()
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", os.cpu_count() or 4))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+_executor: Optional[Executor] = None
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    original_bytes: int
+
+    def to_part(self) -> types.Part:
+        return types.Part.from_bytes(data=self.data, mime_type=self.mime_type)
+
+
+def _to_8bit(image: Image.Image) -> Image.Image:
+    # 16-bit and float radiographs are stretched to 8 bits instead of clipped
+    pixels = np.asarray(image, dtype=np.float32)
+    low, high = float(pixels.min()), float(pixels.max())
+    scale = 255.0 / (high - low) if high > low else 0.0
+    return Image.fromarray(((pixels - low) * scale).astype(np.uint8), mode="L")
+
+
+def preprocess_image_bytes(contents: bytes, radiograph: bool = False, max_dimension: int = IMAGE_MAX_DIMENSION,
+                           output_format: str = IMAGE_OUTPUT_FORMAT, quality: int = IMAGE_QUALITY) -> PreparedImage:
+    """
+    Downscale, optionally convert to grayscale, and re-encode an uploaded image.
+    Re-encoding without passing exif= drops EXIF and other metadata.
+    """
+    image = Image.open(io.BytesIO(contents))
+    # Let the JPEG decoder skip detail we are about to throw away
+    image.draft("L" if radiograph else "RGB", (max_dimension, max_dimension))
+    # Apply the orientation tag before the metadata is dropped
+    image = ImageOps.exif_transpose(image)
+
+    if image.mode in ("I", "I;16", "I;16B", "I;16L", "F"):
+        image = _to_8bit(image)
+    if radiograph:
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format=output_format, quality=quality, optimize=True)
+    return PreparedImage(
+        data=output.getvalue(),
+        mime_type=MIME_TYPES.get(output_format, f"image/{output_format.lower()}"),
+        width=image.width,
+        height=image.height,
+        original_bytes=len(contents)
+    )
+
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if IMAGE_PREPROCESS_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS, thread_name_prefix="image-preprocess")
+    return _executor
+
+
+async def run_in_pool(func, *args):
+    """Run CPU-bound image work in the shared worker pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), partial(func, *args))
+
+
+async def prepare_image(contents: bytes, radiograph: bool = False, max_dimension: Optional[int] = None) -> PreparedImage:
+    """Run the pre-processing stage in the worker pool so Pillow never blocks the event loop"""
+    return await run_in_pool(preprocess_image_bytes, contents, radiograph, max_dimension or IMAGE_MAX_DIMENSION)
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
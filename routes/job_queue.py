@@ -0,0 +1,284 @@
+"""
+Background jobs for the long-running analysis pipelines.
+
+Submitting stores the job (including its input bytes) in a local SQLite
+database and returns its id; a bounded pool of asyncio workers runs the
+registered handler for the job kind. Jobs that were queued or running when
+the process stopped are queued again on the next start. Workers claim a job
+with a conditional UPDATE, so a job never runs twice at the same time, but
+the store is per host: run one application process per JOB_STORE_PATH.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+# Load environment variables
+load_dotenv()
+
+JOB_STORE_PATH = Path(os.getenv("JOB_STORE_PATH", "data/jobs.sqlite3"))
+
+# Jobs executed at the same time
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+
+# Submissions are rejected with 503 once this many jobs are waiting
+JOB_QUEUE_MAX_DEPTH = int(os.getenv("JOB_QUEUE_MAX_DEPTH", 100))
+
+# A job still running after this many starts (it keeps taking the process down) fails instead of being requeued
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+
+# Finished jobs older than this are deleted at startup
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", 7 * 24 * 3600))
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+
+class JobStore:
+    """SQLite-backed job table; every method is blocking and thread safe"""
+
+    def __init__(self, path: Path = JOB_STORE_PATH):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    payload BLOB,
+                    meta TEXT,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def create(self, kind: str, payload: bytes, meta: dict) -> str:
+        job_id = uuid.uuid4().hex
+        self._execute(
+            "INSERT INTO jobs (id, kind, status, payload, meta, created_at) VALUES (?, ?, 'queued', ?, ?, ?)",
+            (job_id, kind, payload, json.dumps(meta), time.time())
+        )
+        return job_id
+
+    def claim(self, job_id: str) -> Optional[sqlite3.Row]:
+        """Mark a queued job running; None if another worker got it first"""
+        claimed = self._execute(
+            "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 "
+            "WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        ).rowcount
+        if not claimed:
+            return None
+        return self._execute("SELECT id, kind, payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def finish(self, job_id: str, result: Optional[dict] = None, error: Optional[str] = None):
+        # The input is dropped once the job is done; only the outcome is kept
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, payload = NULL WHERE id = ?",
+            ("failed" if error is not None else "succeeded",
+             json.dumps(result) if result is not None else None, error, time.time(), job_id)
+        )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self._execute(
+            "SELECT id, kind, status, meta, result, error, attempts, created_at, started_at, finished_at "
+            "FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["meta"] = json.loads(job["meta"]) if job["meta"] else {}
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def fail_exhausted(self, max_attempts: int) -> int:
+        """Fail the jobs a previous process left running that have used up their attempts"""
+        return self._execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, payload = NULL "
+            "WHERE status = 'running' AND attempts >= ?",
+            (f"Job was interrupted {max_attempts} times and will not be retried", time.time(), max_attempts)
+        ).rowcount
+
+    def requeue_interrupted(self) -> List[str]:
+        """Queue again the jobs a previous process left running; return every queued id, oldest first"""
+        self._execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+        rows = self._execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at").fetchall()
+        return [row["id"] for row in rows]
+
+    def purge(self, older_than: float) -> int:
+        return self._execute(
+            "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND finished_at < ?",
+            (time.time() - older_than,)
+        ).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["count"] for row in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JobQueue:
+    def __init__(self, workers: int = JOB_WORKERS, max_depth: int = JOB_QUEUE_MAX_DEPTH):
+        self.workers = workers
+        self.max_depth = max_depth
+        self._handlers: Dict[str, Callable[[bytes], Awaitable[dict]]] = {}
+        self._store: Optional[JobStore] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        # job id -> event set (and replaced) whenever the job changes state
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._watchers: Dict[str, int] = {}
+        self._busy = 0
+        self._busy_seconds = 0.0
+        self._started_at = 0.0
+        self.counters = {"submitted": 0, "succeeded": 0, "failed": 0, "rejected": 0, "requeued": 0}
+
+    def register(self, kind: str, handler: Callable[[bytes], Awaitable[dict]]):
+        """Handler run for jobs of this kind; it gets the payload bytes and returns a JSON-able dict"""
+        self._handlers[kind] = handler
+
+    @property
+    def store(self) -> JobStore:
+        if self._store is None:
+            raise HTTPException(status_code=503, detail="Job queue is not running")
+        return self._store
+
+    async def start(self):
+        self._store = await asyncio.to_thread(JobStore)
+        purged = await asyncio.to_thread(self._store.purge, JOB_RETENTION_SECONDS)
+        exhausted = await asyncio.to_thread(self._store.fail_exhausted, JOB_MAX_ATTEMPTS)
+        pending = await asyncio.to_thread(self._store.requeue_interrupted)
+        if purged or exhausted or pending:
+            logging.info(
+                "Job queue: purged %d finished jobs, failed %d after %d attempts, resuming %d",
+                purged, exhausted, JOB_MAX_ATTEMPTS, len(pending)
+            )
+        self.counters["failed"] += exhausted
+
+        self._queue = asyncio.Queue()
+        for job_id in pending:
+            self._queue.put_nowait(job_id)
+        self.counters["requeued"] += len(pending)
+        self._started_at = time.monotonic()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Interrupted jobs stay "running" in the store and are requeued on the next start
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    async def submit(self, kind: str, payload: bytes, meta: Optional[dict] = None) -> str:
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind: {kind}")
+        store = self.store
+        if self._queue.qsize() >= self.max_depth:
+            self.counters["rejected"] += 1
+            raise HTTPException(status_code=503, detail="Job queue is full, retry later")
+
+        job_id = await asyncio.to_thread(store.create, kind, payload, meta or {})
+        self._queue.put_nowait(job_id)
+        self.counters["submitted"] += 1
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await asyncio.to_thread(self.store.get, job_id)
+
+    @contextmanager
+    def watch(self, job_id: str) -> Iterator[asyncio.Event]:
+        """
+        Event set at the job's next state change; enter before reading the job
+        to not miss one. The event is dropped once the last watcher leaves.
+        """
+        event = self._changed.setdefault(job_id, asyncio.Event())
+        self._watchers[job_id] = self._watchers.get(job_id, 0) + 1
+        try:
+            yield event
+        finally:
+            self._watchers[job_id] -= 1
+            if not self._watchers[job_id]:
+                del self._watchers[job_id]
+                self._changed.pop(job_id, None)
+
+    def _notify(self, job_id: str):
+        event = self._changed.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                job = await asyncio.to_thread(self._store.claim, job_id)
+                if job is not None:
+                    await self._run(job)
+            except Exception:
+                logging.exception("Job worker failed on %s", job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job):
+        self._busy += 1
+        started = time.monotonic()
+        self._notify(job["id"])
+        try:
+            result = await self._handlers[job["kind"]](job["payload"])
+            error = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result = None
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+        finally:
+            self._busy -= 1
+            self._busy_seconds += time.monotonic() - started
+
+        await asyncio.to_thread(self._store.finish, job["id"], result, error)
+        self.counters["failed" if error is not None else "succeeded"] += 1
+        self._notify(job["id"])
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            "workers": self.workers,
+            "busy_workers": self._busy,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_depth": self.max_depth,
+            # Share of worker time spent running jobs since start
+            "utilization": self._busy_seconds / (uptime * self.workers) if uptime else 0.0,
+            **self.counters,
+        }
+
+
+# Shared by the analysis routes; started and stopped in main.lifespan
+job_queue = JobQueue()
@@ -0,0 +1,66 @@
+import asyncio
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+
+from routes.job_queue import job_queue, TERMINAL_STATUSES
+from routes.streaming import STREAMING_HEADERS, sse_event
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"],
+    responses={404: {"description": "Not found"}}
+)
+
+# Seconds between keep-alive events while a subscribed job has not changed
+JOB_EVENTS_HEARTBEAT_SECONDS = 15
+
+
+@router.get("/metrics")
+async def job_metrics():
+    """Queue depth, worker utilization and job counters"""
+    return {
+        **job_queue.stats(),
+        "jobs_by_status": await asyncio.to_thread(job_queue.store.counts),
+    }
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+async def job_events(job_id: str):
+    last_status = None
+    while True:
+        with job_queue.watch(job_id) as changed:
+            job = await job_queue.get(job_id)
+            if job is None:
+                yield sse_event("error", {"detail": "Job not found"})
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield sse_event("status", job)
+                if last_status in TERMINAL_STATUSES:
+                    return
+            else:
+                yield sse_event("heartbeat", {"status": last_status})
+            try:
+                await asyncio.wait_for(changed.wait(), JOB_EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+
+@router.get("/{job_id}/events")
+async def subscribe_job(job_id: str):
+    """
+    Server-Sent Events for one job: a "status" event on every state change,
+    "heartbeat" events while waiting, and the stream ends once the job has
+    succeeded or failed (the last event carries the result or error).
+    """
+    if await job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(job_events(job_id), media_type="text/event-stream", headers=STREAMING_HEADERS)
@@ -0,0 +1,260 @@
+"""
+In-process vector index over the evaluation table.
+
+Vectors of each type live in a preallocated float32 matrix in a memory-mapped
+file, L2-normalized so that a single matmul gives cosine similarity for every
+row. New rows are pulled from Postgres incrementally by tracking the highest
+id loaded per type; without a database the last snapshot on disk is served.
+Rows deleted from Postgres are only dropped by deleting the snapshot
+directory and building again.
+
+In the app the index is loaded and kept fresh by a background task started
+from the lifespan, and all file and matrix work runs in worker threads, so
+requests never wait on a load. Until a type has data (a snapshot on disk or
+a first refresh) ready() is False and retrieval falls back to pgvector.
+
+Build a snapshot (e.g. for CI) with:
+    python -m routes.local_vector_index build
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from routes import db_pool
+from routes.vector_index import VECTOR_INDEX_TYPES
+
+# Load environment variables
+load_dotenv()
+
+# Retrieval engine behind RAGSystem.fetch_relevant_text: "pgvector" or "numpy"
+RAG_RETRIEVAL_ENGINE = os.getenv("RAG_RETRIEVAL_ENGINE", "pgvector").lower()
+
+# Where the memory-mapped snapshots are kept
+LOCAL_VECTOR_INDEX_DIR = Path(os.getenv("LOCAL_VECTOR_INDEX_DIR", "data/vector_index"))
+
+# Minimum seconds between incremental refreshes from Postgres
+LOCAL_VECTOR_INDEX_REFRESH_SECONDS = float(os.getenv("LOCAL_VECTOR_INDEX_REFRESH_SECONDS", 30))
+
+# Rows fetched per refresh round trip
+LOCAL_VECTOR_INDEX_FETCH_SIZE = int(os.getenv("LOCAL_VECTOR_INDEX_FETCH_SIZE", 5000))
+
+EMBEDDING_DIM = 768
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class TypeIndex:
+    """Vectors, ids and texts of one evaluation.type value"""
+
+    def __init__(self, type_value: str, directory: Path = LOCAL_VECTOR_INDEX_DIR, dim: int = EMBEDDING_DIM):
+        self.type_value = type_value
+        self.dim = dim
+        self.base = directory / type_value
+        self.count = 0
+        self.capacity = 0
+        self.max_id = 0
+        self.vectors: Optional[np.memmap] = None
+        self.ids: Optional[np.memmap] = None
+        self.texts: List[str] = []
+        self.refreshed_at = 0.0
+        self.lock = asyncio.Lock()
+        self._load()
+
+    @property
+    def _meta_path(self) -> Path:
+        return self.base.with_suffix(".meta.json")
+
+    def _open(self, capacity: int):
+        self.vectors = np.memmap(self.base.with_suffix(".f32"), dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self.ids = np.memmap(self.base.with_suffix(".ids"), dtype=np.int64, mode="r+", shape=(capacity,))
+        self.capacity = capacity
+
+    def _load(self):
+        texts_path = self.base.with_suffix(".texts.jsonl")
+        if not self._meta_path.exists():
+            # Leftovers of an interrupted first build are not trusted
+            texts_path.unlink(missing_ok=True)
+            return
+        meta = json.loads(self._meta_path.read_text())
+        self.count, self.max_id = meta["count"], meta["max_id"]
+        self._open(meta["capacity"])
+        with open(texts_path, encoding="utf-8") as f:
+            lines = f.readlines()
+        if len(lines) > self.count:
+            # Drop texts of an append that never reached the metadata file
+            with open(texts_path, "w", encoding="utf-8") as f:
+                f.writelines(lines[:self.count])
+        self.texts = [json.loads(line) for line in lines[:self.count]]
+
+    def _grow(self, needed: int):
+        capacity = max(needed, self.capacity * 2, 1024)
+        self.base.parent.mkdir(parents=True, exist_ok=True)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.ids.flush()
+        # Extending the files keeps earlier mappings valid for in-flight searches
+        for suffix, itemsize in ((".f32", 4 * self.dim), (".ids", 8)):
+            with open(self.base.with_suffix(suffix), "ab") as f:
+                f.truncate(capacity * itemsize)
+        self._open(capacity)
+
+    def append(self, ids: np.ndarray, vectors: np.ndarray, texts: List[str]):
+        if not len(ids):
+            return
+        if self.count + len(ids) > self.capacity:
+            self._grow(self.count + len(ids))
+        end = self.count + len(ids)
+        self.vectors[self.count:end] = _normalize(vectors.astype(np.float32))
+        self.ids[self.count:end] = ids
+        self.vectors.flush()
+        self.ids.flush()
+        with open(self.base.with_suffix(".texts.jsonl"), "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(t) + "\n" for t in texts)
+        self.texts.extend(texts)
+        self.count = end
+        self.max_id = int(max(self.max_id, ids.max()))
+        # Metadata is written last so a crash mid-append never exposes partial rows
+        tmp_path = self._meta_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({
+            "count": self.count, "capacity": self.capacity, "max_id": self.max_id, "dim": self.dim
+        }))
+        os.replace(tmp_path, self._meta_path)
+
+    def append_rows(self, rows):
+        """append() for evaluation records; runs in a worker thread"""
+        self.append(
+            np.array([row["id"] for row in rows], dtype=np.int64),
+            np.stack([np.asarray(row["vector"], dtype=np.float32) for row in rows]),
+            [row["text"] for row in rows]
+        )
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """Top-k rows by cosine distance (same metric as pgvector's <=>)"""
+        count = self.count
+        if not count:
+            return []
+        k = min(k, count)
+        scores = self.vectors[:count] @ _normalize(query.astype(np.float32))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.texts[i], float(1 - scores[i])) for i in top]
+
+
+class LocalVectorIndex:
+    def __init__(self, directory: Path = LOCAL_VECTOR_INDEX_DIR):
+        self.directory = directory
+        self._indexes: Dict[str, TypeIndex] = {}
+        self._create_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _get(self, type_value: str) -> TypeIndex:
+        # Loading a snapshot reads every stored text, so this runs in a worker thread
+        with self._create_lock:
+            if type_value not in self._indexes:
+                self._indexes[type_value] = TypeIndex(type_value, self.directory)
+            return self._indexes[type_value]
+
+    async def _index(self, type_value: str) -> TypeIndex:
+        index = self._indexes.get(type_value)
+        return index if index is not None else await asyncio.to_thread(self._get, type_value)
+
+    def ready(self, type_value: str) -> bool:
+        """True once the type has rows from a snapshot or has been refreshed at least once"""
+        index = self._indexes.get(type_value)
+        return index is not None and (index.count > 0 or index.refreshed_at > 0)
+
+    async def start(self, types: List[str] = VECTOR_INDEX_TYPES):
+        """Warm up and keep refreshing the index in the background; called from the app lifespan"""
+        if RAG_RETRIEVAL_ENGINE == "numpy" and self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop(types))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh_loop(self, types: List[str]):
+        while True:
+            for type_value in types:
+                try:
+                    # Loads the snapshot on disk first, then pulls newer rows if a pool is available
+                    await self.refresh(type_value, force=True)
+                except Exception:
+                    logging.exception(f"Error loading the local vector index for {type_value}")
+            await asyncio.sleep(LOCAL_VECTOR_INDEX_REFRESH_SECONDS)
+
+    async def refresh(self, type_value: str, pool=None, force: bool = False):
+        """Pull rows with an id above the highest one already loaded"""
+        index = await self._index(type_value)
+        pool = pool or db_pool.get_pool_or_none()
+        if pool is None or (not force and time.monotonic() - index.refreshed_at < LOCAL_VECTOR_INDEX_REFRESH_SECONDS):
+            return
+        async with index.lock:
+            try:
+                while True:
+                    async with pool.acquire() as conn:
+                        rows = await conn.fetch(
+                            "SELECT id, vector, text FROM evaluation WHERE type = $1 AND id > $2 "
+                            "AND vector IS NOT NULL ORDER BY id LIMIT $3",
+                            type_value, index.max_id, LOCAL_VECTOR_INDEX_FETCH_SIZE
+                        )
+                    if not rows:
+                        break
+                    # Normalizing and writing a batch to the memmap and texts file is blocking work
+                    await asyncio.to_thread(index.append_rows, rows)
+                    if len(rows) < LOCAL_VECTOR_INDEX_FETCH_SIZE:
+                        break
+                index.refreshed_at = time.monotonic()
+            except Exception:
+                # Keep serving the snapshot we already have
+                logging.exception(f"Error refreshing the local vector index for {type_value}")
+
+    async def search(self, type_value: str, query_embedding, k: int = 5) -> List[Tuple[str, float]]:
+        if self._task is None:
+            # No background refresh (e.g. outside the app): refresh on demand
+            await self.refresh(type_value)
+        index = await self._index(type_value)
+        # The matmul releases the GIL, so run it off the event loop
+        return await asyncio.to_thread(index.search, np.asarray(query_embedding, dtype=np.float32), k)
+
+    def stats(self) -> dict:
+        return {
+            type_value: {"rows": index.count, "capacity": index.capacity, "max_id": index.max_id}
+            for type_value, index in self._indexes.items()
+        }
+
+
+# Shared index used when RAG_RETRIEVAL_ENGINE=numpy
+local_vector_index = LocalVectorIndex()
+
+
+async def _build(types: List[str]):
+    import asyncpg
+    from pgvector.asyncpg import register_vector
+
+    pool = await asyncpg.create_pool(os.getenv("DATABASE_URL"), init=register_vector)
+    try:
+        for type_value in types:
+            await local_vector_index.refresh(type_value, pool=pool, force=True)
+        print(json.dumps(local_vector_index.stats(), indent=2))
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "build":
+        raise SystemExit("Usage: python -m routes.local_vector_index build [Type ...]")
+    asyncio.run(_build(sys.argv[2:] or ["Xray", "Scan", "Report"]))
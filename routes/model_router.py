@@ -0,0 +1,210 @@
+"""
+Latency-aware routing and hedged requests across Gemini models.
+
+Every call's latency and outcome is recorded per model over a rolling window.
+A call goes to the requested model unless that model's recent error rate is
+above MODEL_MAX_ERROR_RATE and its fallback is healthier, in which case the
+two swap roles. If the first model has not answered after its own
+MODEL_HEDGE_PERCENTILE latency, the same request is sent to the fallback; the
+first successful answer wins and the other call is cancelled.
+
+Streamed calls are rerouted the same way but never hedged, since text already
+sent to the client cannot be replaced; a completed or failed stream counts as
+one call of the model it went to.
+
+Fallbacks are configured as MODEL_FALLBACKS="primary:fallback,...".
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Dict, Optional
+
+from dotenv import load_dotenv
+from google.genai import types
+
+from routes import gemini_gateway
+
+# Load environment variables
+load_dotenv()
+
+MODEL_FALLBACKS = dict(
+    pair.split(":", 1) for pair in os.getenv(
+        "MODEL_FALLBACKS", "gemini-1.5-flash:gemini-2.0-flash,gemini-2.0-flash:gemini-1.5-flash"
+    ).split(",") if ":" in pair
+)
+
+# Hedge once a call is slower than this percentile of the model's recent latencies
+MODEL_HEDGE_ENABLED = os.getenv("MODEL_HEDGE_ENABLED", "true").lower() == "true"
+MODEL_HEDGE_PERCENTILE = float(os.getenv("MODEL_HEDGE_PERCENTILE", 95))
+
+# Until a model has this many samples, hedge after MODEL_HEDGE_DEFAULT_SECONDS
+MODEL_HEDGE_MIN_SAMPLES = int(os.getenv("MODEL_HEDGE_MIN_SAMPLES", 20))
+MODEL_HEDGE_DEFAULT_SECONDS = float(os.getenv("MODEL_HEDGE_DEFAULT_SECONDS", 10))
+
+# Never hedge sooner than this, so fast models do not double every call
+MODEL_HEDGE_MIN_SECONDS = float(os.getenv("MODEL_HEDGE_MIN_SECONDS", 0.5))
+
+MODEL_MAX_ERROR_RATE = float(os.getenv("MODEL_MAX_ERROR_RATE", 0.5))
+
+# Calls per model kept for the rolling statistics
+MODEL_STATS_WINDOW = int(os.getenv("MODEL_STATS_WINDOW", 200))
+
+
+class ModelStats:
+    def __init__(self, window: int = MODEL_STATS_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)  # True for an error
+        self.cancelled = 0
+
+    def record(self, latency: float, error: bool):
+        if not error:
+            self.latencies.append(latency)
+        self.outcomes.append(error)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        # Nearest-rank percentile
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "samples": len(self.latencies),
+            "p50_seconds": self.percentile(50),
+            "p95_seconds": self.percentile(95),
+            "error_rate": self.error_rate,
+            "cancelled": self.cancelled,
+        }
+
+
+class ModelRouter:
+    def __init__(self, fallbacks: Optional[Dict[str, str]] = None, hedge: bool = MODEL_HEDGE_ENABLED):
+        self.fallbacks = MODEL_FALLBACKS if fallbacks is None else fallbacks
+        self.hedge = hedge
+        self._stats: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "rerouted": 0, "hedged": 0, "hedge_wins": 0}
+
+    def _model_stats(self, model: str) -> ModelStats:
+        with self._lock:
+            return self._stats.setdefault(model, ModelStats())
+
+    def _order(self, model: str):
+        """(first model, hedge model or None) for a request to model"""
+        fallback = self.fallbacks.get(model)
+        if fallback is None:
+            return model, None
+        primary_stats, fallback_stats = self._model_stats(model), self._model_stats(fallback)
+        if (len(primary_stats.outcomes) >= MODEL_HEDGE_MIN_SAMPLES
+                and primary_stats.error_rate > MODEL_MAX_ERROR_RATE
+                and fallback_stats.error_rate < primary_stats.error_rate):
+            self.counters["rerouted"] += 1
+            return fallback, model
+        return model, fallback
+
+    def hedge_delay(self, model: str) -> float:
+        stats = self._model_stats(model)
+        if len(stats.latencies) < MODEL_HEDGE_MIN_SAMPLES:
+            return MODEL_HEDGE_DEFAULT_SECONDS
+        return max(stats.percentile(MODEL_HEDGE_PERCENTILE), MODEL_HEDGE_MIN_SECONDS)
+
+    async def _attempt(self, model: str, contents: Any, config, timeout):
+        start = time.perf_counter()
+        try:
+            response = await gemini_gateway.generate_content(model, contents, config=config, timeout=timeout)
+        except asyncio.CancelledError:
+            # The loser of a hedge never finished, so its elapsed time is not a latency sample;
+            # recording it would pull the percentiles toward the hedge delay
+            self._model_stats(model).cancelled += 1
+            raise
+        except Exception:
+            self._model_stats(model).record(time.perf_counter() - start, error=True)
+            raise
+        self._model_stats(model).record(time.perf_counter() - start, error=False)
+        return response
+
+    async def generate_content(
+        self,
+        model: str,
+        contents: Any,
+        config: Optional[types.GenerateContentConfig] = None,
+        timeout: Optional[float] = None
+    ) -> types.GenerateContentResponse:
+        """gemini_gateway.generate_content with rerouting and a hedged call to the fallback model"""
+        self.counters["calls"] += 1
+        first, second = self._order(model)
+        primary = asyncio.ensure_future(self._attempt(first, contents, config, timeout))
+        if not self.hedge or second is None:
+            return await primary
+
+        tasks = {primary}
+        hedged = False
+        error = None
+        try:
+            # First successful answer wins; an error only counts once both calls have failed
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=None if hedged else self.hedge_delay(first), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    error = error or task.exception()
+                if not hedged:
+                    # The first call is slow (or already failed): ask the other model too
+                    hedged = True
+                    self.counters["hedged"] += 1
+                    tasks.add(asyncio.ensure_future(self._attempt(second, contents, config, timeout)))
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def generate_content_stream(
+        self,
+        model: str,
+        contents: Any,
+        config: Optional[types.GenerateContentConfig] = None,
+        timeout: Optional[float] = None
+    ) -> AsyncIterator[str]:
+        """gemini_gateway.generate_content_stream with rerouting; latency is the whole stream's duration"""
+        self.counters["calls"] += 1
+        first, _ = self._order(model)
+        stats = self._model_stats(first)
+        start = time.perf_counter()
+        try:
+            async for text in gemini_gateway.generate_content_stream(first, contents, config=config, timeout=timeout):
+                yield text
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client went away mid-stream: like a hedge loser, not a latency sample
+            stats.cancelled += 1
+            raise
+        except Exception:
+            stats.record(time.perf_counter() - start, error=True)
+            raise
+        stats.record(time.perf_counter() - start, error=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = {model: stats.snapshot() for model, stats in self._stats.items()}
+        return {
+            "hedge_enabled": self.hedge,
+            "hedge_percentile": MODEL_HEDGE_PERCENTILE,
+            "fallbacks": self.fallbacks,
+            "models": models,
+            **self.counters,
+        }
+
+
+# Shared by the generate_content and generate_content_stream call sites
+model_router = ModelRouter()
@@ -0,0 +1,228 @@
+"""
+Local text extraction for uploaded reports.
+
+PDF pages are rasterized with pdf2image (poppler) and read with Tesseract via
+pytesseract, one page per task in a process pool. Each page carries its mean
+word confidence; pages below OCR_MIN_CONFIDENCE, or with almost no words
+(stamps, charts, handwriting), also keep a downscaled image so the model can
+look at them instead of trusting the text.
+
+pdf_page_fingerprints() identifies each page by its own content (content
+stream plus every image, font and form it references) without rasterizing,
+so callers can skip OCR for pages they have already processed.
+"""
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Iterable, List, Optional
+
+import pytesseract
+from dotenv import load_dotenv
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image, ImageOps
+from pypdf import PdfReader
+from pypdf.errors import PyPdfError
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+from routes.image_preprocess import IMAGE_OUTPUT_FORMAT, IMAGE_QUALITY, MIME_TYPES, PreparedImage
+
+# Load environment variables
+load_dotenv()
+
+# Rasterization resolution; Tesseract is most accurate around 300 dpi for small print
+PDF_RASTER_DPI = int(os.getenv("PDF_RASTER_DPI", 300))
+
+# Pages beyond this are rejected
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", 30))
+
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+OCR_PROCESS_WORKERS = int(os.getenv("OCR_PROCESS_WORKERS", os.cpu_count() or 4))
+
+# Pages under this mean word confidence (0-100) or word count are also sent as images
+OCR_MIN_CONFIDENCE = float(os.getenv("OCR_MIN_CONFIDENCE", 70))
+OCR_MIN_WORDS = int(os.getenv("OCR_MIN_WORDS", 10))
+
+# Longest side of page images sent alongside unreliable text
+OCR_PAGE_IMAGE_MAX_DIMENSION = int(os.getenv("OCR_PAGE_IMAGE_MAX_DIMENSION", 2048))
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+@dataclass
+class OcrPage:
+    page_number: int
+    text: str
+    confidence: float  # mean word confidence, 0-100
+    words: int
+    image: Optional[PreparedImage] = None  # set only when the text is not reliable
+
+    @property
+    def reliable(self) -> bool:
+        return self.image is None
+
+
+def _encode_page(image: Image.Image, source_bytes: int) -> PreparedImage:
+    image = image.convert("L")
+    image.thumbnail((OCR_PAGE_IMAGE_MAX_DIMENSION, OCR_PAGE_IMAGE_MAX_DIMENSION), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format=IMAGE_OUTPUT_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+    return PreparedImage(
+        data=output.getvalue(),
+        mime_type=MIME_TYPES.get(IMAGE_OUTPUT_FORMAT, f"image/{IMAGE_OUTPUT_FORMAT.lower()}"),
+        width=image.width,
+        height=image.height,
+        original_bytes=source_bytes
+    )
+
+
+def ocr_page_image(image: Image.Image, page_number: int, source_bytes: int = 0) -> OcrPage:
+    """Tesseract text (line breaks kept) and mean word confidence for one page"""
+    data = pytesseract.image_to_data(image, lang=OCR_LANG, output_type=pytesseract.Output.DICT)
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        confidence = float(data["conf"][i])
+        if confidence < 0 or not word.strip():
+            continue
+        confidences.append(confidence)
+        lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(word)
+
+    confidence = sum(confidences) / len(confidences) if confidences else 0.0
+    page = OcrPage(
+        page_number=page_number,
+        text="\n".join(" ".join(words) for words in lines.values()),
+        confidence=round(confidence, 1),
+        words=len(confidences)
+    )
+    if confidence < OCR_MIN_CONFIDENCE or page.words < OCR_MIN_WORDS:
+        page.image = _encode_page(image, source_bytes)
+    return page
+
+
+def ocr_pdf_page(pdf_path: str, page_number: int, source_bytes: int) -> OcrPage:
+    """Rasterize and OCR a single page; runs in a worker process"""
+    image = convert_from_path(
+        pdf_path, dpi=PDF_RASTER_DPI, first_page=page_number, last_page=page_number, grayscale=True
+    )[0]
+    return ocr_page_image(image, page_number, source_bytes)
+
+
+def ocr_image_bytes(contents: bytes) -> OcrPage:
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(contents)))
+    return ocr_page_image(image.convert("L"), 1, len(contents))
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Forking a multithreaded server can copy held locks into the child; spawn starts clean
+        _executor = ProcessPoolExecutor(
+            max_workers=OCR_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+
+async def _run(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), partial(func, *args))
+
+
+def is_pdf(contents: bytes) -> bool:
+    return contents[:5] == b"%PDF-"
+
+
+# Keys that point outside the page itself or change without the page's content changing
+_FINGERPRINT_SKIP_KEYS = {"/Parent", "/P", "/StructParents", "/Length"}
+
+
+def _hash_pdf_object(obj, digest, seen: set):
+    """Feed a PDF object and everything it references into digest; object numbers are not hashed"""
+    if isinstance(obj, IndirectObject):
+        reference = (obj.idnum, obj.generation)
+        if reference in seen:
+            digest.update(b"<seen>")
+            return
+        seen.add(reference)
+        obj = obj.get_object()
+    if isinstance(obj, StreamObject):
+        digest.update(b"stream")
+        digest.update(obj.get_data())
+    if isinstance(obj, DictionaryObject):
+        digest.update(b"<<")
+        for key in sorted(obj.keys()):
+            if key in _FINGERPRINT_SKIP_KEYS:
+                continue
+            digest.update(key.encode("utf-8"))
+            _hash_pdf_object(obj.raw_get(key), digest, seen)
+        digest.update(b">>")
+    elif isinstance(obj, ArrayObject):
+        digest.update(b"[")
+        for item in obj:
+            _hash_pdf_object(item, digest, seen)
+        digest.update(b"]")
+    else:
+        digest.update(repr(obj).encode("utf-8"))
+
+
+def pdf_page_fingerprints(contents: bytes) -> Optional[List[bytes]]:
+    """
+    SHA-256 of every page's content, in page order; the same page gets the same
+    fingerprint in another PDF. None when pypdf cannot read the file (OCR still can).
+    """
+    try:
+        reader = PdfReader(io.BytesIO(contents))
+        page_count = len(reader.pages)
+        if page_count > PDF_MAX_PAGES:
+            raise ValueError(f"PDF has {page_count} pages, the limit is {PDF_MAX_PAGES}")
+        fingerprints = []
+        for page in reader.pages:
+            digest = hashlib.sha256()
+            # pypdf copies inherited /Resources, /MediaBox, /CropBox and /Rotate onto each page
+            _hash_pdf_object(page, digest, set())
+            fingerprints.append(digest.digest())
+        return fingerprints
+    except (PyPdfError, RecursionError, KeyError, TypeError):
+        return None
+
+
+def _write_temp_pdf(contents: bytes) -> str:
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as pdf_file:
+        pdf_file.write(contents)
+    return pdf_file.name
+
+
+async def extract_pdf_pages(contents: bytes, page_numbers: Optional[Iterable[int]] = None) -> List[OcrPage]:
+    """OCR every page of a PDF (or only page_numbers, 1-based), pages processed in parallel"""
+    # poppler reads from a file; convert_from_bytes would write one per page otherwise
+    pdf_path = await asyncio.to_thread(_write_temp_pdf, contents)
+    try:
+        info = await asyncio.to_thread(pdfinfo_from_path, pdf_path)
+        page_count = int(info["Pages"])
+        if page_count > PDF_MAX_PAGES:
+            raise ValueError(f"PDF has {page_count} pages, the limit is {PDF_MAX_PAGES}")
+        return list(await asyncio.gather(*(
+            _run(ocr_pdf_page, pdf_path, page_number, len(contents))
+            for page_number in (page_numbers if page_numbers is not None else range(1, page_count + 1))
+        )))
+    finally:
+        await asyncio.to_thread(os.unlink, pdf_path)
+
+
+async def extract_report_pages(contents: bytes, page_numbers: Optional[Iterable[int]] = None) -> List[OcrPage]:
+    """OCR pages of a PDF (all, or only page_numbers) or a single image upload"""
+    if is_pdf(contents):
+        return await extract_pdf_pages(contents, page_numbers)
+    return [await _run(ocr_image_bytes, contents)]
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
@@ -1,13 +1,19 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
 from fastapi.responses import JSONResponse
-from google import genai
-from google.genai import types
 import PIL.Image
+import asyncio
+import hashlib
 import io
 import os
 import time
 from pathlib import Path
+from typing import List, Optional
 from dotenv import load_dotenv
+from routes.model_router import model_router
+from routes.image_preprocess import prepare_image
+from routes.report_ocr import OcrPage, extract_report_pages, is_pdf, pdf_page_fingerprints, PDF_RASTER_DPI, OCR_LANG
+from routes.uploads import upload_memory, upload_size, read_upload
+from routes.analysis_cache import page_summary_cache
 
 # Load environment variables
 load_dotenv()
@@ -18,15 +24,26 @@ router = APIRouter(
     responses={404: {"description": "Not found"}}
 )
 
-# Configure Gemini API client
-client = genai.Client(api_key=os.getenv("Gemini_api_key"))
+# Report pages keep more resolution than scans so small print stays legible
+REPORT_IMAGE_MAX_DIMENSION = int(os.getenv("REPORT_IMAGE_MAX_DIMENSION", 2048))
 
-# Directory to temporarily store uploaded reports
-UPLOAD_DIR = Path("uploads/reports")
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+# Extract text locally and send text first; off sends image uploads straight to the model
+REPORT_OCR_ENABLED = os.getenv("REPORT_OCR_ENABLED", "true").lower() == "true"
+
+REPORT_MODEL = "gemini-2.0-flash"
+
+# Pages of one /upload-multiple request summarized at the same time
+REPORT_MAP_CONCURRENCY = int(os.getenv("REPORT_MAP_CONCURRENCY", 4))
+
+# Bump when REPORT_PAGE_PROMPT changes; it is part of the per-page cache key
+REPORT_PAGE_PROMPT_VERSION = "1"
+REPORT_PAGE_CACHE_NAMESPACE = f"/reports/page:{REPORT_PAGE_PROMPT_VERSION}:{REPORT_MODEL}"
+
+# Same summaries keyed by the page's source content, looked up before OCR; OCR settings change the text
+REPORT_PAGE_SOURCE_NAMESPACE = f"/reports/page-source:{REPORT_PAGE_PROMPT_VERSION}:{REPORT_MODEL}:{PDF_RASTER_DPI}:{OCR_LANG}"
 
 # Allowed file types for medical reports
-ALLOWED_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+ALLOWED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".pdf"}
 
 # System prompt for processing medical reports
 SYSTEM_PROMPT = """
@@ -40,12 +57,70 @@ Review the provided image and generate a concise summary including:
 Use professional dental terminology and format the summary as a doctor's clinical note.
 """
 
+# Prompt for reports whose text was extracted locally
+REPORT_TEXT_PROMPT = """
+You are an expert dental professional tasked with analyzing a dental medical report.
+The report text below was extracted page by page with OCR. Where a page's text may be
+unreliable, the page image follows it; prefer the image for that page.
+Generate a concise summary including:
+1. Patient demographics (name, age, gender, if available)
+2. Key findings from the examination
+3. Diagnosis in professional dental terminology
+4. Recommended actions or follow-ups
+5. Any notable observations or concerns for the doctor
+Use professional dental terminology and format the summary as a doctor's clinical note.
+"""
+
+# Map step: one page of a multi-page packet
+REPORT_PAGE_PROMPT = """
+You are an expert dental professional reading one page of a multi-page dental report packet.
+List every clinically relevant fact on this page as short bullet points: patient demographics,
+examination findings, diagnoses, medications, allergies, procedures, and recommendations.
+Only include what is on the page. If the page has no clinical content, reply "No clinical content."
+If the page image is included, prefer it over the extracted text.
+"""
+
+# Reduce step: merge the per-page notes into one clinical note
+REPORT_REDUCE_PROMPT = """
+You are an expert dental professional. The notes below were extracted from each page of one
+patient's dental report packet, in page order. Merge them into a single concise summary including:
+1. Patient demographics (name, age, gender, if available)
+2. Key findings from the examination
+3. Diagnosis in professional dental terminology
+4. Recommended actions or follow-ups
+5. Any notable observations or concerns for the doctor
+Resolve duplicates, note contradictions between pages, and format the summary as a doctor's clinical note.
+"""
+
+def build_report_contents(pages: List[OcrPage]) -> list:
+    """Prompt, then each page's text; page images only where OCR was not reliable"""
+    contents = [REPORT_TEXT_PROMPT]
+    for page in pages:
+        header = f"--- Page {page.page_number} (OCR confidence {page.confidence:.0f}%) ---"
+        if page.reliable:
+            contents.append(f"{header}\n{page.text}")
+        else:
+            contents.append(f"{header}\n[Text may be unreliable; page image follows]\n{page.text}")
+            contents.append(page.image.to_part())
+    return contents
+
+async def summarize_report_pages(pages: List[OcrPage]) -> str:
+    response = await model_router.generate_content(model=REPORT_MODEL, contents=build_report_contents(pages))
+    return response.text if response.text else "No summary generated."
+
+def ocr_summary(pages: List[OcrPage]) -> list:
+    return [
+        {"page": page.page_number, "confidence": page.confidence, "words": page.words, "image_sent": not page.reliable}
+        for page in pages
+    ]
+
 @router.post("/upload")
 async def upload_and_summarize_report(file: UploadFile = File(...)):
     """
-    Upload a medical report (image), pass it to Gemini API, and generate a summary.
+    Upload a medical report (image or PDF) and generate a summary.
+    Text is extracted locally and sent first; page images are only sent for
+    pages whose OCR confidence is low.
     """
-    file_path = None
     try:
         # Validate file extension
         if Path(file.filename).suffix.lower() not in ALLOWED_EXTENSIONS:
@@ -54,28 +129,32 @@ async def upload_and_summarize_report(file: UploadFile = File(...)):
                 detail=f"Invalid file type. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
             )
 
-        # Validate file size (max 10MB)
-        contents = await file.read()
-        file_size = len(contents)
-        if file_size > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File size exceeds 10MB limit")
+        async with upload_memory.reserve(upload_size(file)):
+            contents = await read_upload(file)
+            file_size = len(contents)
 
-        # Load image from memory
-        image = PIL.Image.open(io.BytesIO(contents))
-
-        # Send image to Gemini API
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[SYSTEM_PROMPT, image]
-        )
+            pages = None
+            if REPORT_OCR_ENABLED or Path(file.filename).suffix.lower() == ".pdf":
+                pages = await extract_report_pages(contents)
+                summary = await summarize_report_pages(pages)
+            else:
+                # Downscaled, metadata-free copy of the report page
+                image = await prepare_image(contents, max_dimension=REPORT_IMAGE_MAX_DIMENSION)
 
-        summary = response.text if response.text else "No summary generated."
+                # Send image to Gemini API
+                response = await model_router.generate_content(
+                    model=REPORT_MODEL,
+                    contents=[SYSTEM_PROMPT, image.to_part()]
+                )
+                summary = response.text if response.text else "No summary generated."
 
         # Metadata and summary
         metadata = {
             "filename": file.filename,
             "size_bytes": file_size,
             "upload_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "pages": len(pages) if pages is not None else 1,
+            "ocr": ocr_summary(pages) if pages is not None else None,
             "summary": summary
         }
 
@@ -84,6 +163,162 @@ async def upload_and_summarize_report(file: UploadFile = File(...)):
             "metadata": metadata
         })
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Upload and summarization failed: {str(e)}")
+
+def page_cache_key(page: OcrPage) -> bytes:
+    # Content only, not the page number, so a page keeps its entry when others are added
+    return page.text.encode("utf-8") + b"\0" + (page.image.data if page.image is not None else b"")
+
+def page_source_keys(contents: bytes) -> Optional[List[bytes]]:
+    """Per-page keys of an upload computed without OCR; None when the PDF cannot be fingerprinted"""
+    if is_pdf(contents):
+        return pdf_page_fingerprints(contents)
+    return [hashlib.sha256(contents).digest()]
+
+async def extract_packet_file(contents: bytes) -> List[tuple]:
+    """
+    (page number, source key, OcrPage or cached map result) for each page of one
+    file. Pages whose content was summarized before come from the cache and are
+    not OCRed; only the remaining pages go through extract_report_pages.
+    """
+    keys = await asyncio.to_thread(page_source_keys, contents)
+    if keys is None:
+        return [(page.page_number, None, page) for page in await extract_report_pages(contents)]
+
+    cached = await asyncio.gather(*(page_summary_cache.get(REPORT_PAGE_SOURCE_NAMESPACE, key) for key in keys))
+    uncached = [page_number for page_number, value in enumerate(cached, start=1) if value is None]
+    ocr_pages = {}
+    if uncached:
+        ocr_pages = {page.page_number: page for page in await extract_report_pages(contents, uncached)}
+    return [
+        (page_number, key, value if value is not None else ocr_pages[page_number])
+        for page_number, (key, value) in enumerate(zip(keys, cached), start=1)
+    ]
+
+async def summarize_page(page: OcrPage, semaphore: asyncio.Semaphore, source_key: Optional[bytes] = None) -> dict:
+    """Map step for one page, reusing the cached summary of identical page content"""
+    key = page_cache_key(page)
+    cached = await page_summary_cache.get(REPORT_PAGE_CACHE_NAMESPACE, key)
+    if cached is not None:
+        summary = cached["summary"]
+    else:
+        contents = [REPORT_PAGE_PROMPT, page.text or "[No text extracted]"]
+        if page.image is not None:
+            contents.append(page.image.to_part())
+        async with semaphore:
+            response = await model_router.generate_content(model=REPORT_MODEL, contents=contents)
+        summary = response.text if response.text else "No clinical content."
+        await page_summary_cache.set(REPORT_PAGE_CACHE_NAMESPACE, key, {"summary": summary})
+    if source_key is not None:
+        # Next time this page is submitted it skips OCR as well
+        await page_summary_cache.set(REPORT_PAGE_SOURCE_NAMESPACE, source_key, {
+            "summary": summary, "confidence": page.confidence, "image_sent": not page.reliable
+        })
+    return {"summary": summary, "cached": cached is not None}
+
+async def reduce_page_summaries(labelled_summaries: List[tuple]) -> str:
+    notes = "\n\n".join(f"--- {label} ---\n{summary}" for label, summary in labelled_summaries)
+    response = await model_router.generate_content(model=REPORT_MODEL, contents=[REPORT_REDUCE_PROMPT, notes])
+    return response.text if response.text else "No summary generated."
+
+@router.post("/upload-multiple")
+async def upload_and_summarize_multiple_reports(files: List[UploadFile] = File(...)):
+    """
+    Summarize a multi-page or multi-file report packet (images and/or PDFs).
+    Every page is summarized concurrently (map, at most REPORT_MAP_CONCURRENCY
+    model calls at a time) and the page notes are merged into one clinical note
+    (reduce). Page summaries are cached by page content (PDF page objects or
+    image bytes) before OCR, so re-submitting a packet with an added page only
+    OCRs and summarizes the new page. A page that fails is reported with its
+    error and left out of the merge.
+    """
+    for file in files:
+        if Path(file.filename).suffix.lower() not in ALLOWED_EXTENSIONS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid file type for {file.filename}. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
+            )
+
+    try:
+        async with upload_memory.reserve(sum(upload_size(file) for file in files)):
+            uploads = [(file.filename, await read_upload(file)) for file in files]
+
+            # Text extraction of the uncached pages of all files in parallel (bounded by the OCR process pool)
+            extracted = await asyncio.gather(
+                *(extract_packet_file(contents) for _, contents in uploads), return_exceptions=True
+            )
+
+        # (filename, page number, source key, page) in packet order; page is the OcrPage, the cached
+        # map result, or the extraction error for a file that could not be read
+        pages = []
+        for (filename, _), file_pages in zip(uploads, extracted):
+            if isinstance(file_pages, Exception):
+                pages.append((filename, None, None, file_pages))
+            else:
+                pages.extend((filename, *file_page) for file_page in file_pages)
+        del uploads
+
+        # Map
+        semaphore = asyncio.Semaphore(REPORT_MAP_CONCURRENCY)
+        mapped = await asyncio.gather(
+            *(summarize_page(page, semaphore, key) for _, _, key, page in pages if isinstance(page, OcrPage)),
+            return_exceptions=True
+        )
+        outcomes = iter(mapped)
+
+        results = []
+        labelled_summaries = []
+        for filename, page_number, _, page in pages:
+            if isinstance(page, Exception):
+                results.append({"filename": filename, "page": None, "status": "error", "error": str(page)})
+                continue
+            if not isinstance(page, OcrPage):
+                results.append({
+                    "filename": filename,
+                    "page": page_number,
+                    "confidence": page["confidence"],
+                    "image_sent": page["image_sent"],
+                    "status": "ok",
+                    "cached": True,
+                })
+                labelled_summaries.append((f"{filename}, page {page_number}", page["summary"]))
+                continue
+            outcome = next(outcomes)
+            result = {
+                "filename": filename,
+                "page": page.page_number,
+                "confidence": page.confidence,
+                "image_sent": not page.reliable,
+            }
+            if isinstance(outcome, Exception):
+                detail = outcome.detail if isinstance(outcome, HTTPException) else str(outcome)
+                result.update({"status": "error", "error": detail})
+            else:
+                result.update({"status": "ok", "cached": outcome["cached"]})
+                labelled_summaries.append((f"{filename}, page {page.page_number}", outcome["summary"]))
+            results.append(result)
+
+        if not labelled_summaries:
+            raise HTTPException(status_code=500, detail={"message": "No page could be summarized", "pages": results})
+
+        # Reduce
+        summary = await reduce_page_summaries(labelled_summaries)
+
+        return JSONResponse(content={
+            "message": f"Summarized {len(labelled_summaries)} of {len(results)} page(s)",
+            "metadata": {
+                "files": len(files),
+                "upload_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "pages": results,
+                "summary": summary
+            }
+        })
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload and summarization failed: {str(e)}")
 
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# A cached answer is reused when the new question is within this cosine distance
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.getenv("SEMANTIC_CACHE_MAX_DISTANCE", 0.05))
+
+# Seconds an answer stays valid
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", 3600))
+
+# LRU bound on cached answers
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 1000))
+
+
+def context_fingerprint(context_text: Optional[str]) -> str:
+    return hashlib.sha256((context_text or "").encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CachedAnswer:
+    namespace: str
+    embedding: np.ndarray  # L2-normalized question embedding
+    fingerprint: str  # fingerprint of the retrieved context the answer was based on
+    answer: str
+    created_at: float
+
+
+class SemanticCache:
+    """
+    Answer cache keyed by question meaning rather than exact text. A lookup hits
+    when a cached question is close enough, the retrieved context is unchanged
+    and the entry has not expired. Entries are per process: invalidate() only
+    clears this worker's cache, the TTL bounds staleness across workers.
+    """
+
+    def __init__(self, max_distance: float = SEMANTIC_CACHE_MAX_DISTANCE,
+                 ttl: float = SEMANTIC_CACHE_TTL_SECONDS, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._next_key = 0
+        # Invalidation is called from sync endpoints running in the threadpool
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, namespace: str, embedding, fingerprint: str) -> Optional[str]:
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl]
+            for key in expired:
+                del self._entries[key]
+            self.counters["expired"] += len(expired)
+
+            candidates = [
+                (key, entry) for key, entry in self._entries.items()
+                if entry.namespace == namespace and entry.fingerprint == fingerprint
+            ]
+            if candidates:
+                distances = 1 - np.stack([entry.embedding for _, entry in candidates]) @ query
+                best = int(np.argmin(distances))
+                if distances[best] <= self.max_distance:
+                    key, entry = candidates[best]
+                    self._entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return entry.answer
+            self.counters["misses"] += 1
+            return None
+
+    def store(self, namespace: str, embedding, fingerprint: str, answer: str):
+        with self._lock:
+            self._entries[self._next_key] = CachedAnswer(
+                namespace, self._normalize(embedding), fingerprint, answer, time.time()
+            )
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def invalidate(self, namespace: str):
+        """Drop every answer of a namespace, e.g. when new rows of that type are added"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry.namespace == namespace]
+            for key in stale:
+                del self._entries[key]
+            self.counters["invalidations"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "max_distance": self.max_distance,
+                "ttl_seconds": self.ttl,
+                **self.counters,
+            }
+
+
+# Shared cache for /ReportRag/analyze answers
+report_answer_cache = SemanticCache()
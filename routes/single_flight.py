@@ -0,0 +1,51 @@
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Dict, Union
+
+
+def request_key(route: str, template_version: str, *parts: Union[str, bytes, None]) -> str:
+    """Hash of route, prompt template version and the raw inputs"""
+    digest = hashlib.sha256()
+    for part in (route, template_version, *parts):
+        data = part if isinstance(part, bytes) else ("" if part is None else str(part)).encode("utf-8")
+        # Length prefix keeps ("ab", "c") and ("a", "bc") apart
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller for a key starts the
+    upstream call, later callers with the same key wait on it and share its
+    result (or exception). The call runs as its own task, so a caller that
+    disconnects does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.counters = {"leaders": 0, "coalesced": 0}
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter went away
+
+    async def do(self, key: str, func: Callable[..., Awaitable], *args, **kwargs):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.counters["leaders"] += 1
+        else:
+            self.counters["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._inflight), **self.counters}
+
+
+# Shared by the LLM routes
+single_flight = SingleFlight()
@@ -1,12 +1,21 @@
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
-from google import generativeai as genai
+from fastapi.responses import JSONResponse, StreamingResponse
+from google.genai import types
 import os
+import asyncio
+import ast
 import time
 import json
+import threading
+from datetime import datetime
+from functools import partial
+from typing import List, Optional
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2.extras import execute_values
+from pydantic import BaseModel, ValidationError
+from routes.model_router import model_router
+from routes.single_flight import single_flight, request_key
+from routes.soap_note_store import soap_note_store, soap_note_row, fetch_notes_page, SOAP_NOTES_PAGE_SIZE
+from routes.streaming import sse_event, ndjson_line, STREAMING_HEADERS, CleanupStreamingResponse
 
 # Load environment variables
 load_dotenv()
@@ -17,12 +26,6 @@ router = APIRouter(
     responses={404: {"description": "Not found"}}
 )
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("Gemini_api_key"))
-
-# PostgreSQL connection details
-DB_URL = os.getenv("DB_URL")
-
 # Example JSON structure
 example_json = {
     "subjective": "Patient's chief complaint, history, and reported symptoms.",
@@ -32,6 +35,31 @@ example_json = {
     "summary": "A concise overview for quick reference."
 }
 
+# Schema the model is constrained to; mirrors example_json
+class SoapNote(BaseModel):
+    subjective: str
+    objective: str
+    assessment: str
+    plan: str
+    summary: str
+
+class SoapNoteBatchItem(BaseModel):
+    patient_id: str
+    patient_info: str
+
+class SoapNoteBatchRequest(BaseModel):
+    patients: List[SoapNoteBatchItem]
+
+# Bump when SOAP_NOTE_PROMPT_TEMPLATE or the response schema changes; it is part of the request-coalescing key
+SOAP_NOTE_PROMPT_VERSION = "2"
+
+# Notes of one /generate/batch request generated at the same time, and the most patients per request
+SOAP_BATCH_CONCURRENCY = int(os.getenv("SOAP_BATCH_CONCURRENCY", 4))
+SOAP_BATCH_MAX_ITEMS = int(os.getenv("SOAP_BATCH_MAX_ITEMS", 100))
+
+# A request for the same patient_id/patient_info within this many seconds of a failure counts as a retry
+SOAP_RETRY_WINDOW_SECONDS = float(os.getenv("SOAP_RETRY_WINDOW_SECONDS", 600))
+
 # Advanced prompt template for generating a SOAP note
 SOAP_NOTE_PROMPT_TEMPLATE = """
 You are an expert dental professional tasked with creating a SOAP note from a dentist's perspective to reduce documentation workload. Based on the provided patient information and clinical findings, generate a structured SOAP note with the following sections:
@@ -45,49 +73,212 @@ Patient Information and Findings:
 {patient_info}
 """
 
-def get_db_connection():
-    """Establish a connection to the PostgreSQL database"""
+SOAP_NOTE_MODEL = 'gemini-1.5-flash'  # Adjust model name as needed
+
+SOAP_NOTE_CONFIG = types.GenerateContentConfig(
+    temperature=0.2,  # Low temperature for precise, professional output
+    max_output_tokens=1500,  # Allow for detailed SOAP notes
+    response_mime_type="application/json",  # Native structured output instead of fenced text
+    response_schema=SoapNote
+)
+
+class SoapNoteMetrics:
+    """How often model output needed the local repair pass or failed, and how often clients retried"""
+
+    def __init__(self, retry_window: float = SOAP_RETRY_WINDOW_SECONDS):
+        self.retry_window = retry_window
+        self._lock = threading.Lock()
+        self._failed_at = {}  # request key -> time of its last failure
+        self.counters = {"requests": 0, "parsed": 0, "repaired": 0, "parse_failures": 0, "failures": 0, "retries": 0}
+
+    def record_request(self, key: str):
+        now = time.time()
+        with self._lock:
+            self.counters["requests"] += 1
+            # Forget old failures so the map stays bounded by the window
+            self._failed_at = {k: t for k, t in self._failed_at.items() if now - t <= self.retry_window}
+            if self._failed_at.pop(key, None) is not None:
+                self.counters["retries"] += 1
+
+    def record_failure(self, key: str):
+        with self._lock:
+            self.counters["failures"] += 1
+            self._failed_at[key] = time.time()
+
+    def record_parse(self, outcome: str):
+        with self._lock:
+            self.counters[outcome] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.counters["requests"] or 1
+            parses = (self.counters["parsed"] + self.counters["repaired"] + self.counters["parse_failures"]) or 1
+            return {
+                **self.counters,
+                "repair_rate": self.counters["repaired"] / parses,
+                "parse_failure_rate": self.counters["parse_failures"] / parses,
+                "retry_rate": self.counters["retries"] / requests,
+            }
+
+soap_note_metrics = SoapNoteMetrics()
+
+def validate_soap_input(patient_id: str, patient_info: str):
+    if not patient_id or not patient_info or len(patient_info.strip()) < 20:
+        raise HTTPException(
+            status_code=400,
+            detail="Please provide a valid patient_id and detailed patient information (minimum 20 characters)"
+        )
+
+def build_soap_note_prompt(patient_info: str) -> str:
+    # Format the prompt with actual patient information
+    return SOAP_NOTE_PROMPT_TEMPLATE.format(
+        example_json=example_json,
+        patient_info=patient_info
+    )
+
+def strip_trailing_commas(text: str) -> str:
+    """Drop commas that directly precede } or ]; string contents are left alone"""
+    result = []
+    quote = None
+    escaped = False
+    comma = None  # index in result of a comma followed so far only by whitespace
+    for char in text:
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote, comma = char, None
+        elif char == ",":
+            comma = len(result)
+        elif char in "}]":
+            if comma is not None:
+                result[comma] = ""
+            comma = None
+        elif not char.isspace():
+            comma = None
+        result.append(char)
+    return "".join(result)
+
+# Curly quotes and the straight quote they stand for when they delimit a string
+_SMART_QUOTES = {"\u201c": '"', "\u201d": '"', "\u2018": "'", "\u2019": "'"}
+
+def replace_smart_quote_delimiters(text: str) -> str:
+    """
+    Straighten curly quotes that open or close a string. Curly quotes inside a
+    string (e.g. "reports \u201csharp\u201d pain") are content and are kept; a curly
+    quote only closes a string when a ':', ',', '}' or ']' follows it.
+    """
+    result = []
+    quote = None  # straight quote delimiting the current string
+    curly = False  # whether that string was opened by a curly quote
+    escaped = False
+    for i, char in enumerate(text):
+        if quote is None:
+            if char in "\"'":
+                quote, curly = char, False
+            elif char in _SMART_QUOTES:
+                quote, curly = _SMART_QUOTES[char], True
+                char = quote
+        elif escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif not curly:
+            if char == quote:
+                quote = None
+        elif char == quote or _SMART_QUOTES.get(char) == quote:
+            if text[i + 1:].lstrip()[:1] in ("", ":", ",", "}", "]"):
+                char, quote = quote, None
+            elif char == quote:
+                char = "\\" + char
+        result.append(char)
+    return "".join(result)
+
+def repair_soap_json(text: str) -> dict:
+    """
+    One local repair pass for near-JSON: markdown fences or prose around the
+    object, smart quotes, trailing commas, raw newlines inside strings,
+    Python-style single-quoted dicts and capitalized section names
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError("No JSON object in response")
+    candidate = text[start:end + 1]
     try:
-        conn = psycopg2.connect(DB_URL)
-        return conn
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database connection failed: {str(e)}")
+        data = json.loads(candidate, strict=False)
+    except json.JSONDecodeError:
+        candidate = strip_trailing_commas(replace_smart_quote_delimiters(candidate))
+        try:
+            data = json.loads(candidate, strict=False)
+        except json.JSONDecodeError:
+            data = ast.literal_eval(candidate)
+    if not isinstance(data, dict):
+        raise ValueError("Response is not a valid JSON object")
+    return {str(key).strip().lower(): value for key, value in data.items()}
 
-def save_soap_note(patient_id: str, soap_note: dict, generated_at: str):
-    """Save the SOAP note to the PostgreSQL database"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def parse_soap_note(response_text: str, parsed: Optional[SoapNote] = None) -> dict:
+    """
+    Validate the model output against SoapNote. Schema-constrained output
+    normally validates directly; otherwise one local repair pass is tried
+    before giving up, so a bad response never needs a second generation.
+    """
+    if isinstance(parsed, SoapNote):
+        soap_note_metrics.record_parse("parsed")
+        return parsed.model_dump()
     try:
-        # Create table if it doesn't exist
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS soap_notes (
-                id SERIAL PRIMARY KEY,
-                patient_id VARCHAR(50) NOT NULL,
-                soap_note JSONB NOT NULL,
-                generated_at TIMESTAMP NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        soap_note = SoapNote.model_validate_json(response_text or "")
+        soap_note_metrics.record_parse("parsed")
+        return soap_note.model_dump()
+    except ValidationError:
+        pass
+    try:
+        soap_note = SoapNote.model_validate(repair_soap_json(response_text or ""))
+        soap_note_metrics.record_parse("repaired")
+        return soap_note.model_dump()
+    except (ValueError, SyntaxError, TypeError) as e:
+        # ValidationError is a ValueError; literal_eval raises TypeError for e.g. {[1]: 2}
+        soap_note_metrics.record_parse("parse_failures")
+        raise HTTPException(status_code=500, detail=f"Failed to parse SOAP note: {str(e)}")
 
-        # Convert dictionary to proper JSON string
-        soap_note_json = json.dumps(soap_note)
+async def finalize_soap_note(patient_id: str, patient_info: str, response_text: str,
+                             parsed: Optional[SoapNote] = None) -> dict:
+    """Parse, timestamp and save a generated SOAP note"""
+    soap_note = parse_soap_note(response_text, parsed)
 
-        # Insert the SOAP note
-        cursor.execute("""
-            INSERT INTO soap_notes (patient_id, soap_note, generated_at)
-            VALUES (%s, %s, %s)
-            RETURNING id
-        """, (patient_id, soap_note_json, generated_at))
+    # Generate timestamp
+    generated_at = time.strftime("%Y-%m-%d %H:%M:%S")
 
-        conn.commit()
-        note_id = cursor.fetchone()[0]
-        return note_id
+    # Save to database; note_id is None while a write-behind save is still queued
+    try:
+        note_id = await soap_note_store.save(patient_id, soap_note, generated_at)
+    except HTTPException:
+        raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to save SOAP note: {str(e)}")
-    finally:
-        cursor.close()
-        conn.close()
+
+    # Prepare result
+    return {
+        "patient_id": patient_id,
+        "patient_info": patient_info,
+        "soap_note": soap_note,
+        "generated_at": generated_at,
+        "note_id": note_id
+    }
+
+async def create_soap_note(patient_id: str, patient_info: str) -> dict:
+    """Generate, parse and save one SOAP note"""
+    # Generate the SOAP note
+    response = await model_router.generate_content(
+        model=SOAP_NOTE_MODEL,
+        contents=[build_soap_note_prompt(patient_info)],
+        config=SOAP_NOTE_CONFIG
+    )
+
+    return await finalize_soap_note(patient_id, patient_info, response.text, response.parsed)
 
 @router.post("/generate")
 async def generate_soap_note(patient_id: str, patient_info: str):
@@ -97,53 +288,17 @@ async def generate_soap_note(patient_id: str, patient_info: str):
     """
     try:
         # Validate input
-        if not patient_id or not patient_info or len(patient_info.strip()) < 20:
-            raise HTTPException(
-                status_code=400,
-                detail="Please provide a valid patient_id and detailed patient information (minimum 20 characters)"
-            )
+        validate_soap_input(patient_id, patient_info)
 
-        # Configure Gemini model
-        model = genai.GenerativeModel('gemini-1.5-flash')  # Adjust model name as needed
-
-        # Format the prompt with actual patient information
-        soap_note_prompt = SOAP_NOTE_PROMPT_TEMPLATE.format(
-            example_json=example_json,
-            patient_info=patient_info
-        )
-
-        # Generate the SOAP note
-        response = model.generate_content(
-            contents=[soap_note_prompt],
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.2,  # Low temperature for precise, professional output
-                max_output_tokens=1500  # Allow for detailed SOAP notes
-            )
-        )
+        key = request_key("/soap/generate", SOAP_NOTE_PROMPT_VERSION, patient_id, patient_info)
+        soap_note_metrics.record_request(key)
 
-        # Parse the response as JSON
+        # A double-submit waits on the first request and gets the same saved note
         try:
-            cleaned_response = response.text.replace("```json", "").replace("```", "").strip()
-            soap_note = json.loads(cleaned_response)
-            if not isinstance(soap_note, dict):
-                raise ValueError("Response is not a valid JSON object")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to parse SOAP note: {str(e)}")
-
-        # Generate timestamp
-        generated_at = time.strftime("%Y-%m-%d %H:%M:%S")
-
-        # Save to database
-        note_id = save_soap_note(patient_id, soap_note, generated_at)
-
-        # Prepare result
-        result = {
-            "patient_id": patient_id,
-            "patient_info": patient_info,
-            "soap_note": soap_note,
-            "generated_at": generated_at,
-            "note_id": note_id
-        }
+            result = await single_flight.do(key, create_soap_note, patient_id, patient_info)
+        except Exception:
+            soap_note_metrics.record_failure(key)
+            raise
 
         return JSONResponse(content={
             "message": "SOAP note generated and saved successfully",
@@ -153,6 +308,197 @@ async def generate_soap_note(patient_id: str, patient_info: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"SOAP note generation or saving failed: {str(e)}")
 
+async def stream_soap_note_events(patient_id: str, patient_info: str):
+    """
+    SSE events: "chunk" for each piece of the draft as it is generated, then
+    "done" with the validated and saved note once the stream completes
+    (or "error" if generation, parsing or saving fails)
+    """
+    parts = []
+    key = request_key("/soap/generate", SOAP_NOTE_PROMPT_VERSION, patient_id, patient_info)
+    soap_note_metrics.record_request(key)
+    try:
+        async for text in model_router.generate_content_stream(
+            model=SOAP_NOTE_MODEL,
+            contents=[build_soap_note_prompt(patient_info)],
+            config=SOAP_NOTE_CONFIG
+        ):
+            parts.append(text)
+            yield sse_event("chunk", {"text": text})
+
+        yield sse_event("done", await finalize_soap_note(patient_id, patient_info, "".join(parts)))
+    except Exception as e:
+        soap_note_metrics.record_failure(key)
+        # Headers are already sent, so errors are reported in-band
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        yield sse_event("error", {"detail": f"SOAP note generation or saving failed: {detail}"})
+
+@router.post("/generate/stream")
+async def generate_soap_note_stream(patient_id: str, patient_info: str):
+    """
+    Stream the SOAP note draft as Server-Sent Events, then validate and save it
+    """
+    validate_soap_input(patient_id, patient_info)
+    return StreamingResponse(
+        stream_soap_note_events(patient_id, patient_info),
+        media_type="text/event-stream",
+        headers=STREAMING_HEADERS
+    )
+
+async def generate_batch_item(index: int, item: SoapNoteBatchItem, semaphore: asyncio.Semaphore) -> dict:
+    """Generate and parse one note of a batch; failures are reported in the item instead of raised"""
+    key = None
+    try:
+        validate_soap_input(item.patient_id, item.patient_info)
+        key = request_key("/soap/generate", SOAP_NOTE_PROMPT_VERSION, item.patient_id, item.patient_info)
+        soap_note_metrics.record_request(key)
+        async with semaphore:
+            response = await model_router.generate_content(
+                model=SOAP_NOTE_MODEL,
+                contents=[build_soap_note_prompt(item.patient_info)],
+                config=SOAP_NOTE_CONFIG
+            )
+        return {
+            "index": index,
+            "patient_id": item.patient_id,
+            "status": "ok",
+            "soap_note": parse_soap_note(response.text, response.parsed),
+            "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+        }
+    except Exception as e:
+        if key is not None:
+            soap_note_metrics.record_failure(key)
+        return {
+            "index": index,
+            "patient_id": item.patient_id,
+            "status": "error",
+            "error": e.detail if isinstance(e, HTTPException) else str(e)
+        }
+
+async def save_batch_results(results: List[dict]) -> dict:
+    """
+    Save every generated note of a batch with one bulk insert.
+    Returns {"saved": bool, "note_ids": {index: note_id}} or the save error.
+    """
+    generated = [result for result in results if result["status"] == "ok"]
+    try:
+        note_ids = await soap_note_store.save_many([
+            soap_note_row(result["patient_id"], result["soap_note"], result["generated_at"])
+            for result in generated
+        ])
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        return {"saved": False, "error": f"Failed to save SOAP notes: {detail}"}
+    return {"saved": True, "note_ids": {result["index"]: note_id for result, note_id in zip(generated, note_ids)}}
+
+async def stream_batch_results(tasks: List[asyncio.Task]):
+    """
+    NDJSON line per patient as soon as its note is generated (without note_id),
+    then a summary line with the note ids once the whole batch is saved
+    """
+    results = []
+    for next_result in asyncio.as_completed(tasks):
+        result = await next_result
+        results.append(result)
+        yield ndjson_line(result)
+    failed = sum(1 for result in results if result["status"] == "error")
+    yield ndjson_line({
+        "done": True,
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        **(await save_batch_results(results))
+    })
+
+async def cancel_batch(tasks: List[asyncio.Task]):
+    """Client went away: stop the generations nobody will read"""
+    for task in tasks:
+        task.cancel()
+
+@router.post("/generate/batch")
+async def generate_soap_note_batch(request: SoapNoteBatchRequest, stream: bool = False):
+    """
+    Generate SOAP notes for several patients concurrently (at most SOAP_BATCH_CONCURRENCY at a time)
+    and save them all with a single bulk insert once every generation has finished.
+    A patient whose note fails is reported with status "error" without failing the others.
+    With stream=true each result is sent as an NDJSON line as soon as it is ready (in completion
+    order, with its input index), followed by a summary line carrying the saved note ids.
+    Notes are always written through, also when SOAP_NOTE_WRITE_BEHIND is enabled.
+    """
+    if not request.patients:
+        raise HTTPException(status_code=400, detail="Please provide at least one patient")
+    if len(request.patients) > SOAP_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch can contain at most {SOAP_BATCH_MAX_ITEMS} patients"
+        )
+
+    semaphore = asyncio.Semaphore(SOAP_BATCH_CONCURRENCY)
+    tasks = [
+        asyncio.create_task(generate_batch_item(index, item, semaphore))
+        for index, item in enumerate(request.patients)
+    ]
+
+    if stream:
+        # Cancellation is tied to the response, so it also happens when the body is never iterated
+        return CleanupStreamingResponse(
+            stream_batch_results(tasks), cleanup=partial(cancel_batch, tasks),
+            media_type="application/x-ndjson", headers=STREAMING_HEADERS
+        )
+
+    # Cancelling the gather (client disconnect) cancels the pending generations too
+    results = await asyncio.gather(*tasks)
+    saved = await save_batch_results(results)
+    for result in results:
+        if result["status"] != "ok":
+            continue
+        if saved["saved"]:
+            result["note_id"] = saved["note_ids"][result["index"]]
+        else:
+            # The generated draft is kept in the item so it is not lost with the insert
+            result.update(status="error", error=saved["error"])
+
+    succeeded = sum(1 for result in results if result["status"] == "ok")
+    return JSONResponse(content={
+        "message": f"Generated and saved {succeeded} of {len(results)} SOAP note(s)",
+        "data": results
+    })
+
+async def notes_page(**filters) -> dict:
+    try:
+        return await fetch_notes_page(**filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to read SOAP notes: {str(e)}")
+
+@router.get("/patients/{patient_id}/notes")
+async def get_patient_notes(patient_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                            cursor: Optional[str] = None, limit: int = SOAP_NOTES_PAGE_SIZE):
+    """
+    One patient's SOAP notes, newest first, optionally limited to start <= generated_at < end.
+    Pass the returned next_cursor to get the following page; it is null on the last page.
+    """
+    return await notes_page(patient_id=patient_id, start=start, end=end, cursor=cursor, limit=limit)
+
+@router.get("/notes/search")
+async def search_notes(q: str, patient_id: Optional[str] = None, start: Optional[datetime] = None,
+                       end: Optional[datetime] = None, cursor: Optional[str] = None,
+                       limit: int = SOAP_NOTES_PAGE_SIZE):
+    """
+    SOAP notes whose assessment matches the search terms, newest first.
+    Example: q="periapical abscess" or q="gingivitis -periodontitis"
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Please provide search terms")
+    return await notes_page(search=q, patient_id=patient_id, start=start, end=end, cursor=cursor, limit=limit)
+
+@router.get("/metrics")
+async def soap_metrics():
+    """Parse outcomes of generated notes (direct, repaired, failed) and client retry rate"""
+    return {**soap_note_metrics.stats(), "store": soap_note_store.stats()}
+
 @router.get("/health")
 async def health_check():
     return {"status": "healthy", "message": "SOAP note generation service is running"}
\ No newline at end of file
@@ -0,0 +1,350 @@
+"""
+Persistence for generated SOAP notes.
+
+The soap_notes table and its indexes are created once by migrate() at
+startup rather than on every insert, and rows are written and read through
+the shared "app" asyncpg pool. Reads are keyset-paginated newest first on
+(generated_at, id) within a patient, using the matching composite index.
+
+Acknowledgement semantics:
+
+- Write-through (default): save() returns after the INSERT has committed,
+  so a successful response means the note is durable and carries its id.
+- Write-behind (SOAP_NOTE_WRITE_BEHIND=true): save() only appends the note to
+  an in-memory queue of this process and returns None for the id. A
+  background task writes the queue with one COPY every
+  SOAP_NOTE_FLUSH_SECONDS, or sooner once SOAP_NOTE_FLUSH_BATCH notes are
+  waiting. A successful response therefore does NOT mean the note is stored:
+  notes still queued are lost if the process crashes (a clean shutdown
+  flushes them), and a batch that still fails after SOAP_NOTE_FLUSH_RETRIES
+  attempts is logged and dropped. When SOAP_NOTE_QUEUE_MAX notes are already
+  waiting, save() falls back to a write-through insert, which keeps memory
+  bounded and slows callers down to what the database can take.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from routes import db_pool
+
+# Load environment variables
+load_dotenv()
+
+SOAP_NOTE_WRITE_BEHIND = os.getenv("SOAP_NOTE_WRITE_BEHIND", "false").lower() == "true"
+
+# Queued notes are written at least this often, or as soon as a batch is full
+SOAP_NOTE_FLUSH_SECONDS = float(os.getenv("SOAP_NOTE_FLUSH_SECONDS", 1))
+SOAP_NOTE_FLUSH_BATCH = int(os.getenv("SOAP_NOTE_FLUSH_BATCH", 200))
+SOAP_NOTE_FLUSH_RETRIES = int(os.getenv("SOAP_NOTE_FLUSH_RETRIES", 3))
+
+# Above this many queued notes, saves are written through instead
+SOAP_NOTE_QUEUE_MAX = int(os.getenv("SOAP_NOTE_QUEUE_MAX", 5000))
+
+SOAP_NOTE_POOL = "app"
+
+SOAP_NOTE_COLUMNS = ("patient_id", "soap_note", "generated_at")
+
+# Rows per page of the read endpoints, and the most a client may ask for
+SOAP_NOTES_PAGE_SIZE = int(os.getenv("SOAP_NOTES_PAGE_SIZE", 20))
+SOAP_NOTES_MAX_PAGE_SIZE = int(os.getenv("SOAP_NOTES_MAX_PAGE_SIZE", 100))
+
+# Text search configuration of the assessment index; queries must use the same one
+SOAP_NOTES_SEARCH_CONFIG = "english"
+ASSESSMENT_TSVECTOR = f"to_tsvector('{SOAP_NOTES_SEARCH_CONFIG}', soap_note ->> 'assessment')"
+
+SOAP_NOTES_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS soap_notes (
+        id SERIAL PRIMARY KEY,
+        patient_id VARCHAR(50) NOT NULL,
+        soap_note JSONB NOT NULL,
+        generated_at TIMESTAMP NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
+
+# (name, DDL); built with CONCURRENTLY so an existing table stays writable, which has to run outside a transaction
+SOAP_NOTES_INDEXES = [
+    # One patient's history and keyset pages through it; scanned backwards for newest first
+    ("soap_notes_patient_generated",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS soap_notes_patient_generated "
+     "ON soap_notes (patient_id, generated_at, id)"),
+    # Term search in the assessment section of the JSONB note
+    ("soap_notes_assessment_search",
+     "CREATE INDEX CONCURRENTLY IF NOT EXISTS soap_notes_assessment_search "
+     f"ON soap_notes USING gin (({ASSESSMENT_TSVECTOR}))"),
+]
+
+# Serializes the table DDL of several workers starting at once
+_MIGRATION_LOCK_ID = 0x50a9_0001
+
+# Held by the one worker building the indexes; separate from the DDL lock, see migrate()
+_INDEX_BUILD_LOCK_ID = 0x50a9_0003
+
+Row = Tuple[str, str, datetime]
+
+
+def soap_note_row(patient_id: str, soap_note: dict, generated_at: str) -> Row:
+    """Database row for a note; generated_at uses the "%Y-%m-%d %H:%M:%S" response format"""
+    return patient_id, json.dumps(soap_note), datetime.strptime(generated_at, "%Y-%m-%d %H:%M:%S")
+
+
+async def index_valid(conn, name: str) -> Optional[bool]:
+    """pg_index.indisvalid of an index, or None when it does not exist"""
+    return await conn.fetchval("""
+        SELECT x.indisvalid FROM pg_class c JOIN pg_index x ON x.indexrelid = c.oid
+        WHERE c.relname = $1
+    """, name)
+
+
+async def migrate(pool) -> None:
+    """
+    Create the soap_notes table and its indexes once.
+
+    CREATE INDEX CONCURRENTLY waits for every open transaction, so it must
+    not run while other workers can be blocked on a lock its builder holds.
+    The table DDL therefore runs in a transaction under a transaction-scoped
+    advisory lock, and the indexes are built afterwards by whichever worker
+    gets the separate build lock without waiting; the others skip them. An
+    interrupted build leaves an INVALID index that IF NOT EXISTS would keep,
+    so invalid indexes are dropped and rebuilt.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _MIGRATION_LOCK_ID)
+            for statement in SOAP_NOTES_SCHEMA:
+                await conn.execute(statement)
+
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", _INDEX_BUILD_LOCK_ID):
+            logging.info("Another process is building the soap_notes indexes")
+            return
+        try:
+            for name, statement in SOAP_NOTES_INDEXES:
+                if await index_valid(conn, name) is False:
+                    await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                await conn.execute(statement)
+                if not await index_valid(conn, name):
+                    raise RuntimeError(f"Index {name} is not valid after the build")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", _INDEX_BUILD_LOCK_ID)
+
+
+async def insert_rows(conn, rows: List[Row]) -> List[int]:
+    """Insert rows in one round trip and return their ids in the same order"""
+    records = await conn.fetch(
+        """
+        INSERT INTO soap_notes (patient_id, soap_note, generated_at)
+        SELECT * FROM unnest($1::varchar[], $2::jsonb[], $3::timestamp[])
+        RETURNING id
+        """,
+        [row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows]
+    )
+    return [record["id"] for record in records]
+
+
+def encode_cursor(generated_at: datetime, note_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([generated_at.isoformat(), note_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of encode_cursor; raises ValueError for a cursor it did not produce"""
+    try:
+        generated_at, note_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(generated_at), int(note_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _local_naive(value: datetime) -> datetime:
+    # generated_at is stored as server-local time without a time zone
+    return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+
+
+def _note_dict(record) -> dict:
+    return {
+        "id": record["id"],
+        "patient_id": record["patient_id"],
+        "soap_note": json.loads(record["soap_note"]),
+        "generated_at": record["generated_at"].strftime("%Y-%m-%d %H:%M:%S"),
+        "created_at": record["created_at"].strftime("%Y-%m-%d %H:%M:%S") if record["created_at"] else None,
+    }
+
+
+async def fetch_notes_page(
+    patient_id: Optional[str] = None,
+    search: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = SOAP_NOTES_PAGE_SIZE
+) -> dict:
+    """
+    One page of notes, newest first, filtered by patient, generated_at range
+    [start, end) and/or assessment search terms (web search syntax, e.g.
+    "periapical abscess -caries"). Returns {"notes": [...], "next_cursor"};
+    next_cursor is None on the last page.
+    """
+    conditions: List[str] = []
+    params: List[Any] = []
+
+    def param(value) -> str:
+        params.append(value)
+        return f"${len(params)}"
+
+    # Only the filters that are set go into the SQL, so the planner sees plain range predicates
+    if patient_id is not None:
+        conditions.append(f"patient_id = {param(patient_id)}")
+    if search:
+        conditions.append(
+            f"{ASSESSMENT_TSVECTOR} @@ websearch_to_tsquery('{SOAP_NOTES_SEARCH_CONFIG}', {param(search)})"
+        )
+    if start is not None:
+        conditions.append(f"generated_at >= {param(_local_naive(start))}")
+    if end is not None:
+        conditions.append(f"generated_at < {param(_local_naive(end))}")
+    if cursor is not None:
+        before_generated_at, before_id = decode_cursor(cursor)
+        conditions.append(f"(generated_at, id) < ({param(before_generated_at)}, {param(before_id)})")
+
+    limit = max(1, min(limit, SOAP_NOTES_MAX_PAGE_SIZE))
+    query = f"""
+        SELECT id, patient_id, soap_note, generated_at, created_at
+        FROM soap_notes
+        {"WHERE " + " AND ".join(conditions) if conditions else ""}
+        ORDER BY generated_at DESC, id DESC
+        LIMIT {param(limit + 1)}
+    """
+    async with db_pool.get_pool(SOAP_NOTE_POOL).acquire() as conn:
+        records = await conn.fetch(query, *params)
+
+    # The extra row only tells whether another page exists
+    page = records[:limit]
+    next_cursor = None
+    if len(records) > limit:
+        next_cursor = encode_cursor(page[-1]["generated_at"], page[-1]["id"])
+    return {"notes": [_note_dict(record) for record in page], "next_cursor": next_cursor}
+
+
+class SoapNoteStore:
+    def __init__(self, write_behind: bool = SOAP_NOTE_WRITE_BEHIND):
+        self.write_behind = write_behind
+        self._pending: List[Row] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.counters = {"written": 0, "queued": 0, "flushes": 0, "flush_errors": 0, "dropped": 0, "overflow_writes": 0}
+
+    async def start(self):
+        pool = db_pool.get_pool_or_none(SOAP_NOTE_POOL)
+        if pool is None:
+            logging.warning("SOAP note store: no %s database pool, saving notes will fail", SOAP_NOTE_POOL)
+        else:
+            try:
+                await migrate(pool)
+            except Exception as e:
+                logging.exception(f"Error migrating the soap_notes table: {str(e)}")
+
+        if self.write_behind:
+            self._wake = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._stopping = False
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            # Not cancelled: the loop writes whatever is still queued before the pool closes
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+
+    @property
+    def queueing(self) -> bool:
+        return self._task is not None and not self._stopping
+
+    async def save(self, patient_id: str, soap_note: dict, generated_at: str) -> Optional[int]:
+        """Store one note; returns its id, or None when it was only queued (see module docstring)"""
+        row = soap_note_row(patient_id, soap_note, generated_at)
+        if self.queueing and len(self._pending) < SOAP_NOTE_QUEUE_MAX:
+            self._pending.append(row)
+            self.counters["queued"] += 1
+            if len(self._pending) >= SOAP_NOTE_FLUSH_BATCH:
+                self._wake.set()
+            return None
+        if self.queueing:
+            self.counters["overflow_writes"] += 1
+        return (await self.save_many([row]))[0]
+
+    async def save_many(self, rows: List[Row]) -> List[int]:
+        """Write-through insert of several rows in one statement"""
+        if not rows:
+            return []
+        async with db_pool.get_pool(SOAP_NOTE_POOL).acquire() as conn:
+            ids = await insert_rows(conn, rows)
+        self.counters["written"] += len(ids)
+        return ids
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=SOAP_NOTE_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception(f"Error flushing SOAP notes: {str(e)}")
+            if self._stopping:
+                return
+
+    async def flush(self):
+        """Write queued notes in batches of SOAP_NOTE_FLUSH_BATCH with COPY"""
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:SOAP_NOTE_FLUSH_BATCH]
+                await self._write_batch(batch)
+                # Saves during the write were appended after the batch
+                del self._pending[:len(batch)]
+
+    async def _write_batch(self, batch: List[Row]):
+        for attempt in range(1, SOAP_NOTE_FLUSH_RETRIES + 1):
+            try:
+                async with db_pool.get_pool(SOAP_NOTE_POOL).acquire() as conn:
+                    await conn.copy_records_to_table("soap_notes", records=batch, columns=SOAP_NOTE_COLUMNS)
+                self.counters["flushes"] += 1
+                self.counters["written"] += len(batch)
+                return
+            except Exception as e:
+                self.counters["flush_errors"] += 1
+                logging.warning("SOAP note flush attempt %d/%d failed: %s", attempt, SOAP_NOTE_FLUSH_RETRIES, e)
+                if attempt < SOAP_NOTE_FLUSH_RETRIES:
+                    await asyncio.sleep(min(2 ** attempt, 10))
+        self.counters["dropped"] += len(batch)
+        logging.error(
+            "Dropped %d SOAP notes after %d failed flushes: %s",
+            len(batch), SOAP_NOTE_FLUSH_RETRIES, [(row[0], row[2].isoformat()) for row in batch]
+        )
+
+    def stats(self) -> dict:
+        return {
+            "write_behind": self.queueing,
+            "pending": len(self._pending),
+            "flush_seconds": SOAP_NOTE_FLUSH_SECONDS,
+            "flush_batch": SOAP_NOTE_FLUSH_BATCH,
+            **self.counters,
+        }
+
+
+# Shared by every SOAP note write
+soap_note_store = SoapNoteStore()
@@ -0,0 +1,41 @@
+import json
+from typing import Awaitable, Callable
+
+from anyio import CancelScope
+from fastapi.responses import StreamingResponse
+
+# Response headers that stop proxies from buffering a streamed body
+STREAMING_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+def sse_event(event: str, data) -> str:
+    """Format one Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def ndjson_line(data) -> str:
+    return json.dumps(data) + "\n"
+
+
+class CleanupStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that awaits cleanup() once the response is over, however
+    it ends. A generator's own finally does not run if the client disconnects
+    before the body is iterated, so resources the generator consumes (reserved
+    upload memory, background tasks) are released here instead.
+    """
+
+    def __init__(self, content, cleanup: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(content, **kwargs)
+        self.cleanup = cleanup
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Shielded: the request's cancel scope may already be cancelled
+            with CancelScope(shield=True):
+                await self.cleanup()
@@ -1,8 +1,12 @@
 from fastapi import APIRouter, HTTPException
-from google import generativeai as genai
+from fastapi.responses import StreamingResponse
+from google.genai import types
 import os
 from dotenv import load_dotenv
 import time
+from routes.model_router import model_router
+from routes.single_flight import single_flight, request_key
+from routes.streaming import sse_event, STREAMING_HEADERS
 
 # Load environment variables
 load_dotenv()
@@ -13,8 +17,8 @@ router = APIRouter(
     responses={404: {"description": "Treatment plan not found"}}
 )
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("Gemini_api_key"))
+# Bump when TREATMENT_PLAN_PROMPT changes; it is part of the request-coalescing key
+TREATMENT_PLAN_PROMPT_VERSION = "1"
 
 # Advanced prompt for treatment planning
 TREATMENT_PLAN_PROMPT = """
@@ -30,6 +34,39 @@ Use professional dental terminology and provide a structured, step-by-step plan.
 Input condition: {condition}
 """
 
+TREATMENT_PLAN_MODEL = 'gemini-1.5-flash'  # Using text-only model since we're passing text
+
+TREATMENT_PLAN_CONFIG = types.GenerateContentConfig(
+    temperature=0.2,  # Slightly higher for more practical suggestions
+    max_output_tokens=1500  # Allow for detailed treatment plans
+)
+
+def validate_condition(condition: str):
+    if not condition or len(condition.strip()) < 10:
+        raise HTTPException(
+            status_code=400,
+            detail="Please provide a detailed description of the dental condition"
+        )
+
+async def create_treatment_plan(condition: str) -> dict:
+    """Run the Gemini call for one condition and structure the result"""
+    # Format the prompt with the condition
+    formatted_prompt = TREATMENT_PLAN_PROMPT.format(condition=condition)
+
+    # Generate treatment plan
+    response = await model_router.generate_content(
+        model=TREATMENT_PLAN_MODEL,
+        contents=formatted_prompt,
+        config=TREATMENT_PLAN_CONFIG
+    )
+
+    # Structure the response
+    return {
+        "condition": condition,
+        "treatment_plan": response.text,
+        "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+    }
+
 @router.post("/generate-plan")
 async def generate_treatment_plan(condition: str):
     """
@@ -38,39 +75,54 @@ async def generate_treatment_plan(condition: str):
     """
     try:
         # Validate input
-        if not condition or len(condition.strip()) < 10:
-            raise HTTPException(
-                status_code=400,
-                detail="Please provide a detailed description of the dental condition"
-            )
-
-        # Configure Gemini model
-        model = genai.GenerativeModel('gemini-1.5-flash')  # Using text-only model since we're passing text
-
-        # Format the prompt with the condition
-        formatted_prompt = TREATMENT_PLAN_PROMPT.format(condition=condition)
-
-        # Generate treatment plan
-        response = model.generate_content(
-            formatted_prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.2,  # Slightly higher for more practical suggestions
-                max_output_tokens=1500  # Allow for detailed treatment plans
-            )
-        )
+        validate_condition(condition)
 
-        # Structure the response
-        treatment_plan = {
-            "condition": condition,
-            "treatment_plan": response.text,
-            "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")
-        }
+        # Identical requests already in flight share one upstream call
+        treatment_plan = await single_flight.do(
+            request_key("/treatment/generate-plan", TREATMENT_PLAN_PROMPT_VERSION, condition),
+            create_treatment_plan,
+            condition
+        )
 
         return treatment_plan
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Treatment plan generation failed: {str(e)}")
 
+async def stream_treatment_plan_events(condition: str):
+    """SSE events: one "chunk" per streamed piece of text, then "done" (or "error")"""
+    parts = []
+    try:
+        async for text in model_router.generate_content_stream(
+            model=TREATMENT_PLAN_MODEL,
+            contents=TREATMENT_PLAN_PROMPT.format(condition=condition),
+            config=TREATMENT_PLAN_CONFIG
+        ):
+            parts.append(text)
+            yield sse_event("chunk", {"text": text})
+
+        yield sse_event("done", {
+            "condition": condition,
+            "treatment_plan": "".join(parts),
+            "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+        })
+    except Exception as e:
+        # Headers are already sent, so errors are reported in-band
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        yield sse_event("error", {"detail": f"Treatment plan generation failed: {detail}"})
+
+@router.post("/generate-plan/stream")
+async def generate_treatment_plan_stream(condition: str):
+    """
+    Stream a treatment plan as Server-Sent Events while Gemini generates it
+    """
+    validate_condition(condition)
+    return StreamingResponse(
+        stream_treatment_plan_events(condition),
+        media_type="text/event-stream",
+        headers=STREAMING_HEADERS
+    )
+
 @router.get("/health")
 async def health_check():
     return {"status": "healthy", "message": "Treatment plan service is running"}
\ No newline at end of file
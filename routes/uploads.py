@@ -0,0 +1,180 @@
+"""
+Bounded upload handling.
+
+UploadSizeLimitMiddleware rejects a request body as soon as it is known to be
+too large: from Content-Length before anything is read, or while the body is
+streamed in when there is no Content-Length. read_upload() then enforces the
+per-file limit in chunks, and upload_memory caps the upload bytes all
+concurrent requests hold in memory at once.
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+# Load environment variables
+load_dotenv()
+
+# Largest single uploaded file
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 10 * 1024 * 1024))
+
+# Largest request body on routes without a tighter limit (multi-file uploads)
+REQUEST_MAX_BYTES = int(os.getenv("REQUEST_MAX_BYTES", 128 * 1024 * 1024))
+
+# Upload bytes held in memory across all requests; requests wait for room
+UPLOAD_MEMORY_BUDGET_BYTES = int(os.getenv("UPLOAD_MEMORY_BUDGET_BYTES", 128 * 1024 * 1024))
+UPLOAD_MEMORY_WAIT_SECONDS = float(os.getenv("UPLOAD_MEMORY_WAIT_SECONDS", 30))
+
+UPLOAD_CHUNK_BYTES = 256 * 1024
+
+# Room for multipart boundaries and part headers around one file
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# Single-file routes are held to the file limit instead of REQUEST_MAX_BYTES
+SINGLE_FILE_ROUTES = ("/scans/upload", "/scans/upload/jobs", "/xray/analyze", "/xray/analyze/jobs", "/reports/upload")
+
+
+def size_limit_detail(filename: Optional[str], max_bytes: int) -> str:
+    return f"File {filename} exceeds {max_bytes // (1024 * 1024)}MB limit"
+
+
+class UploadSizeLimitMiddleware:
+    def __init__(self, app, max_bytes: int = REQUEST_MAX_BYTES, path_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_limits = path_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.path_limits.get(scope["path"].rstrip("/") or "/", self.max_bytes)
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            # Rejected before a single body byte is read
+            response = JSONResponse(status_code=413, content={"detail": "Request body too large"})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI passes HTTPExceptions raised while parsing the body through unchanged
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def add_upload_limits(app):
+    """Add UploadSizeLimitMiddleware with the single-file routes held to UPLOAD_MAX_BYTES"""
+    app.add_middleware(
+        UploadSizeLimitMiddleware,
+        max_bytes=REQUEST_MAX_BYTES,
+        path_limits={path: UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD_BYTES for path in SINGLE_FILE_ROUTES},
+    )
+
+
+class UploadMemoryBudget:
+    """
+    Byte-counting semaphore for upload data held in memory. A request reserves
+    what it is about to read in one step (clamped to the capacity, so a single
+    reservation can never wait on itself) and gets 503 if room does not free
+    up within UPLOAD_MEMORY_WAIT_SECONDS.
+    """
+
+    def __init__(self, capacity: int = UPLOAD_MEMORY_BUDGET_BYTES, wait_seconds: float = UPLOAD_MEMORY_WAIT_SECONDS):
+        self.capacity = capacity
+        self.wait_seconds = wait_seconds
+        self.in_use = 0
+        self.peak = 0
+        self._waiting = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self.counters = {"reservations": 0, "waited": 0, "timeouts": 0}
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Created lazily so it binds to the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self, nbytes: int) -> int:
+        nbytes = min(nbytes, self.capacity)
+        condition = self._get_condition()
+        async with condition:
+            if self.in_use + nbytes > self.capacity:
+                self.counters["waited"] += 1
+                self._waiting += 1
+                try:
+                    await asyncio.wait_for(
+                        condition.wait_for(lambda: self.in_use + nbytes <= self.capacity), self.wait_seconds
+                    )
+                except asyncio.TimeoutError:
+                    self.counters["timeouts"] += 1
+                    raise HTTPException(status_code=503, detail="Server is busy with other uploads, retry later")
+                finally:
+                    self._waiting -= 1
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+            self.counters["reservations"] += 1
+        return nbytes
+
+    async def release(self, nbytes: int):
+        condition = self._get_condition()
+        async with condition:
+            self.in_use -= nbytes
+            condition.notify_all()
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int):
+        reserved = await self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            await self.release(reserved)
+
+    def stats(self) -> dict:
+        return {
+            "capacity_bytes": self.capacity,
+            "in_use_bytes": self.in_use,
+            "peak_bytes": self.peak,
+            "waiting": self._waiting,
+            **self.counters,
+        }
+
+
+def upload_size(file: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES) -> int:
+    """Size of a parsed upload, 413 if it is over the limit; unknown sizes count as max_bytes"""
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=size_limit_detail(file.filename, max_bytes))
+    return file.size if file.size is not None else max_bytes
+
+
+async def read_upload(file: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES) -> bytes:
+    """Read an upload in chunks, stopping with 413 as soon as it passes max_bytes"""
+    upload_size(file, max_bytes)
+    chunks = []
+    total = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            raise HTTPException(status_code=413, detail=size_limit_detail(file.filename, max_bytes))
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+# Shared by every route that reads uploads into memory
+upload_memory = UploadMemoryBudget()
@@ -0,0 +1,161 @@
+import logging
+import os
+import re
+import threading
+import time
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+# Load environment variables
+load_dotenv()
+
+# Index method for evaluation.vector: "hnsw" or "ivfflat"
+VECTOR_INDEX_METHOD = os.getenv("VECTOR_INDEX_METHOD", "hnsw").lower()
+
+# One partial index is built per evaluation.type value
+VECTOR_INDEX_TYPES = [t.strip() for t in os.getenv("VECTOR_INDEX_TYPES", "Xray,Scan,Report").split(",") if t.strip()]
+
+# Create missing indexes in a background thread when the app starts
+VECTOR_INDEX_ON_STARTUP = os.getenv("VECTOR_INDEX_ON_STARTUP", "false").lower() == "true"
+
+# Held while building so two processes never build (or drop) the same indexes at once
+_BUILD_LOCK_ID = 0x50a9_0002
+
+# Build-time parameters
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 64))
+IVFFLAT_LISTS = int(os.getenv("IVFFLAT_LISTS", 100))
+
+# Query-time parameters (higher = better recall, slower queries)
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 40))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", 10))
+
+
+def index_name(type_value: str, method: str = VECTOR_INDEX_METHOD) -> str:
+    return f"evaluation_vector_{method}_{re.sub(r'[^a-z0-9]+', '_', type_value.lower())}"
+
+
+def index_ddl(type_value: str, method: str = VECTOR_INDEX_METHOD) -> str:
+    """CREATE INDEX statement for the cosine partial index of one type"""
+    if method == "hnsw":
+        params = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}"
+    elif method == "ivfflat":
+        params = f"lists = {IVFFLAT_LISTS}"
+    else:
+        raise ValueError(f"Unsupported vector index method: {method}")
+    literal = type_value.replace("'", "''")
+    return (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name(type_value, method)} "
+        f"ON evaluation USING {method} (vector vector_cosine_ops) WITH ({params}) "
+        f"WHERE type = '{literal}'"
+    )
+
+
+def search_settings() -> List[str]:
+    """Session settings applied before similarity queries"""
+    return [
+        f"SET hnsw.ef_search = {HNSW_EF_SEARCH}",
+        f"SET ivfflat.probes = {IVFFLAT_PROBES}",
+    ]
+
+
+def index_valid(conn, name: str) -> Optional[bool]:
+    """pg_index.indisvalid of an index, or None when it does not exist"""
+    row = conn.execute(text("""
+        SELECT x.indisvalid FROM pg_class c JOIN pg_index x ON x.indexrelid = c.oid
+        WHERE c.relname = :name
+    """), {"name": name}).fetchone()
+    return None if row is None else row[0]
+
+
+def ensure_vector_indexes(engine, rebuild: bool = False) -> List[dict]:
+    """
+    Create the per-type partial indexes that are missing (or drop and rebuild
+    them). CONCURRENTLY keeps the table writable while an index builds, which
+    requires running outside a transaction. An interrupted CONCURRENTLY build
+    leaves an INVALID index that IF NOT EXISTS would skip, so invalid indexes
+    are dropped and rebuilt, and an index is only reported "ready" once
+    pg_index says it is valid.
+    """
+    results = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": _BUILD_LOCK_ID}).scalar():
+            return [
+                {"type": type_value, "index": index_name(type_value), "status": "failed",
+                 "error": "Another process is building the vector indexes"}
+                for type_value in VECTOR_INDEX_TYPES
+            ]
+        try:
+            for type_value in VECTOR_INDEX_TYPES:
+                name = index_name(type_value)
+                try:
+                    if rebuild or index_valid(conn, name) is False:
+                        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+                    conn.execute(text(index_ddl(type_value)))
+                    if not index_valid(conn, name):
+                        raise RuntimeError(f"Index {name} is not valid after the build")
+                    results.append({"type": type_value, "index": name, "status": "ready"})
+                except Exception as e:
+                    logging.exception(f"Error creating vector index {name}")
+                    results.append({"type": type_value, "index": name, "status": "failed", "error": str(e)})
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": _BUILD_LOCK_ID})
+    return results
+
+
+class VectorIndexBuild:
+    """Runs ensure_vector_indexes on a background thread, one build per process at a time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.state = {"status": "idle"}
+
+    def start(self, engine, rebuild: bool = False) -> bool:
+        """Start a build; False when this process is already building"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self.state = {"status": "running", "rebuild": rebuild, "started_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+            self._thread = threading.Thread(target=self._run, args=(engine, rebuild), daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self, engine, rebuild: bool):
+        try:
+            results = ensure_vector_indexes(engine, rebuild=rebuild)
+            outcome = {
+                "status": "failed" if any(result["status"] == "failed" for result in results) else "ready",
+                "indexes": results,
+            }
+        except Exception as e:
+            logging.exception("Vector index build failed")
+            outcome = {"status": "failed", "error": str(e)}
+        with self._lock:
+            self.state = {**self.state, **outcome, "finished_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.state)
+
+
+# Started at startup (VECTOR_INDEX_ON_STARTUP) and by POST /vector-index/build
+vector_index_build = VectorIndexBuild()
+
+
+def vector_index_status(engine) -> List[dict]:
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT i.indexname, i.indexdef, pg_relation_size(c.oid) AS size_bytes, x.indisvalid
+            FROM pg_indexes i
+            JOIN pg_class c ON c.relname = i.indexname
+            JOIN pg_index x ON x.indexrelid = c.oid
+            WHERE i.tablename = 'evaluation' AND i.indexdef ~* 'using (hnsw|ivfflat)'
+            ORDER BY i.indexname
+        """)).fetchall()
+    return [
+        {"index": row[0], "definition": row[1], "size_bytes": row[2], "valid": row[3]}
+        for row in rows
+    ]
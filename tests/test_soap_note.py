@@ -0,0 +1,48 @@
+import pytest
+from fastapi import HTTPException
+
+from routes.soap_note import parse_soap_note, repair_soap_json
+
+NOTE = {
+    "subjective": "Patient reports “sharp” pain on biting",
+    "objective": "Caries, } noted on tooth 36",
+    "assessment": "Irreversible pulpitis",
+    "plan": "Root canal treatment",
+    "summary": "Symptomatic tooth 36",
+}
+
+
+def test_quoted_clinical_text_in_fenced_reply_parses_unchanged():
+    reply = (
+        "```json\n{"
+        '"subjective": "Patient reports “sharp” pain on biting", '
+        '"objective": "Caries, } noted on tooth 36", '
+        '"assessment": "Irreversible pulpitis", '
+        '"plan": "Root canal treatment", '
+        '"summary": "Symptomatic tooth 36"'
+        "}\n```"
+    )
+    assert parse_soap_note(reply) == NOTE
+
+
+def test_smart_quote_delimiters_and_trailing_commas_are_repaired():
+    reply = (
+        "{“subjective”: “Patient reports “sharp” pain on biting”, "
+        '"objective": "Caries, } noted on tooth 36", '
+        '"assessment": "Irreversible pulpitis", '
+        '"plan": "Root canal treatment", '
+        '"summary": "Symptomatic tooth 36",}'
+    )
+    assert parse_soap_note(reply) == NOTE
+
+
+def test_python_style_dict_with_apostrophe_is_repaired():
+    assert repair_soap_json("{‘Plan’: ‘Review the patient’s x-ray’,}") == {
+        "plan": "Review the patient’s x-ray"
+    }
+
+
+def test_unhashable_key_is_a_parse_failure():
+    with pytest.raises(HTTPException) as excinfo:
+        parse_soap_note("{[1]: 2}")
+    assert excinfo.value.status_code == 500